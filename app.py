@@ -1,17 +1,33 @@
-from flask import Flask, render_template, jsonify, send_file, request, session, Response, redirect, url_for, flash
+from flask import Flask, render_template, jsonify, send_file, send_from_directory, request, session, g, Response, redirect, url_for, flash, abort
 import requests
 import pandas as pd
 from datetime import datetime, timedelta
 import io
+import gzip
+import json
+import hashlib
+import hmac
+import secrets
 import time
+import bisect
+import re
+import random
+import threading
+import uuid
+import cProfile
+import pstats
+import tracemalloc
+from collections import OrderedDict, Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import zipfile
 import os
+import shutil
+import click
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_migrate import Migrate
-from flask_bcrypt import Bcrypt
+from sqlalchemy.exc import IntegrityError
 from forms import RegistrationForm, LoginForm, OzonShopForm, CdekAccountForm
-from models import db, User, OzonShop, CdekAccount
+from models import db, bcrypt, User, OzonShop, CdekAccount, LabelRequest, PrefetchedLabel, OzonPostingState, LabelJob, LabelJobChunk, RejectedTrack
 
 app = Flask(__name__)
 
@@ -37,10 +53,38 @@ else:
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # Отключаем отслеживание модификаций
 
+# --- Конфигурация стоимости bcrypt ---
+BCRYPT_MIN_LOG_ROUNDS = 4
+BCRYPT_MAX_LOG_ROUNDS = 16
+BCRYPT_DEFAULT_LOG_ROUNDS = 12
+
+def calibrate_bcrypt_log_rounds(target_ms, min_rounds=BCRYPT_MIN_LOG_ROUNDS, max_rounds=BCRYPT_MAX_LOG_ROUNDS):
+    """Подбирает максимальный cost bcrypt, при котором один хеш укладывается в target_ms на этой машине."""
+    chosen_rounds = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        started = time.perf_counter()
+        bcrypt.generate_password_hash('bcrypt-calibration', rounds=rounds)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms > target_ms:
+            break
+        chosen_rounds = rounds
+        # Каждый следующий cost вдвое дороже — дальше мерить нет смысла
+        if elapsed_ms * 2 > target_ms:
+            break
+    return chosen_rounds
+
+# BCRYPT_LOG_ROUNDS задает cost явно и одинаково для всех воркеров. Подобрать его под целевую задержку
+# можно командой `flask bench-login --target-ms N`: замер при старте каждого воркера давал бы разные cost,
+# и вход на "чужом" воркере каждый раз пересчитывал бы хеш.
+if os.environ.get('BCRYPT_TARGET_MS') and not os.environ.get('BCRYPT_LOG_ROUNDS'):
+    print("BCRYPT: BCRYPT_TARGET_MS is no longer applied at startup; run `flask bench-login --target-ms` and set BCRYPT_LOG_ROUNDS.")
+bcrypt_log_rounds = int(os.environ.get('BCRYPT_LOG_ROUNDS', BCRYPT_DEFAULT_LOG_ROUNDS))
+app.config['BCRYPT_LOG_ROUNDS'] = max(BCRYPT_MIN_LOG_ROUNDS, min(bcrypt_log_rounds, 31))
+
 # --- Инициализация расширений Flask ---
 db.init_app(app) # Теперь db инициализируется ПОСЛЕ установки URI
 migrate = Migrate(app, db)
-bcrypt = Bcrypt(app)
+bcrypt.init_app(app)
 
 # --- Конфигурация Flask-Login ---
 login_manager = LoginManager(app)
@@ -62,14 +106,235 @@ def load_user(user_id):
 
 # --- API Endpoint константы (остаются) ---
 OZON_FBS_LIST_URL = "https://api-seller.ozon.ru/v3/posting/fbs/list"
+OZON_FBS_GET_URL = "https://api-seller.ozon.ru/v3/posting/fbs/get"
 CDEK_TOKEN_URL = "https://api.cdek.ru/v2/oauth/token"
 CDEK_API_BASE_URL = "https://api.cdek.ru/v2"
 MAX_CDEK_ORDERS_PER_BATCH = 100 
 CDEK_POLLING_ATTEMPTS = 15 
 CDEK_POLLING_INTERVAL_SECONDS = 3
+LABEL_REQUEST_DEADLINE_SECONDS = int(os.environ.get('LABEL_REQUEST_DEADLINE_SECONDS', 20)) # сколько маршрут ждет этикетки, прежде чем отдать ссылку на задачу
+LABEL_CHUNK_DEADLINE_SECONDS = int(os.environ.get('LABEL_CHUNK_DEADLINE_SECONDS', 90)) # бюджет одной попытки пачки в планировщике
+LABEL_CHUNK_MAX_ATTEMPTS = 3
+LABEL_JOB_WAIT_POLL_SECONDS = 0.5
+CDEK_TRACK_NUMBER_PATTERN = re.compile(os.environ.get('CDEK_TRACK_NUMBER_PATTERN', r'^[A-Za-z0-9][A-Za-z0-9/-]{3,63}$'))
+REJECTED_TRACK_TTL_HOURS = int(os.environ.get('REJECTED_TRACK_TTL_HOURS', 6)) # сколько не отправлять в СДЭК отклоненный им трек
+LABEL_REQUEST_RETENTION_DAYS = int(os.environ.get('LABEL_REQUEST_RETENTION_DAYS', 60))
+LABEL_REQUEST_PURGE_INTERVAL_SECONDS = 3600
+LABEL_REQUEST_LOOKUP_BATCH_SIZE = 500
+LABEL_PREFETCH_MAX_WORKERS = int(os.environ.get('LABEL_PREFETCH_MAX_WORKERS', 2)) # на один процесс gunicorn
+LABEL_PREFETCH_BATCH_SIZE = 10 # треков в одной печатной форме СДЭК; готовая пачка отдается, только если выбраны все ее треки
+LABEL_PREFETCH_MAX_TRACKS_PER_FETCH = 300
+LABEL_PREFETCH_TTL_HOURS = int(os.environ.get('LABEL_PREFETCH_TTL_HOURS', 72))
+LABEL_PREFETCH_RETRY_MINUTES = 30
+LABEL_PREFETCH_SLOT_WAIT_SECONDS = 300 # сколько предзагрузка ждет свободного слота аккаунта, прежде чем отложить треки
+LABEL_SCHEDULER_THREADS = int(os.environ.get('LABEL_SCHEDULER_THREADS', 2)) # на один процесс gunicorn
+LABEL_MAX_RUNNING_CHUNKS_PER_USER = int(os.environ.get('LABEL_MAX_RUNNING_CHUNKS_PER_USER', 1))
+LABEL_MAX_RUNNING_CHUNKS_PER_ACCOUNT = int(os.environ.get('LABEL_MAX_RUNNING_CHUNKS_PER_ACCOUNT', 1))
+LABEL_SCHEDULER_IDLE_SECONDS = 1
+LABEL_CHUNK_STALE_MINUTES = 15 # пачка в работе дольше этого считается брошенной (рестарт воркера)
+LABEL_JOB_RETENTION_HOURS = int(os.environ.get('LABEL_JOB_RETENTION_HOURS', 24))
+# Сохраненное состояние отправлений: без push — короткий TTL (0 — всегда запрос в Ozon), с push — интервал полной сверки
+ORDERS_CACHE_TTL_SECONDS = int(os.environ.get('ORDERS_CACHE_TTL_SECONDS', 0))
+ORDERS_PUSH_RECONCILE_SECONDS = int(os.environ.get('ORDERS_PUSH_RECONCILE_SECONDS', 900))
+POSTING_SYNC_MAX_ATTEMPTS = 3 # повторы сохранения выгрузки при конфликте с параллельной сверкой того же магазина
+POSTING_STATE_RETENTION_DAYS = int(os.environ.get('POSTING_STATE_RETENTION_DAYS', 30)) # сколько хранить ушедшие из awaiting_deliver
+ORDERS_WARMUP_ON_LOGIN = os.environ.get('ORDERS_WARMUP_ON_LOGIN', 'default') # default / all / off
+ORDERS_WARMUP_TTL_SECONDS = int(os.environ.get('ORDERS_WARMUP_TTL_SECONDS', 300)) # сколько прогретое при входе состояние ждет первого показа
+ORDERS_WARMUP_MAX_WORKERS = int(os.environ.get('ORDERS_WARMUP_MAX_WORKERS', 2)) # на один процесс gunicorn
+ORDERS_WARMUP_WAIT_SECONDS = 30 # сколько страница заказов ждет уже идущий прогрев своего магазина
+POSTINGS_ARCHIVE_DIR = os.environ.get('POSTINGS_ARCHIVE_DIR', os.path.join(app.instance_path, 'postings_archive'))
+POSTINGS_ARCHIVE_COMPRESSION = 'zstd'
+REPORT_MAX_DAYS = int(os.environ.get('REPORT_MAX_DAYS', 400))
+REPORT_DEFAULT_DAYS = 30
+ARCHIVE_STATUS_RESOLVE_MAX = 200 # сколько ушедших при сверке отправлений дочитывать из Ozon за раз (статус: отгружено/отменено)
+REPORT_GROUP_FIELDS = {'shop': 'Магазин', 'day': 'День', 'month': 'Месяц', 'warehouse': 'Склад', 'offer_id': 'Артикул'}
+OZON_PUSH_APP_NAME = "Ozon-CDEK Helper"
+# Служебные поля строк заказа: не выводятся колонками в таблице и не попадают в Excel
+ORDERS_TABLE_CACHE_SIZE = 32
+GZIP_MIN_SIZE_BYTES = 1024
+SEARCH_INDEX_CACHE_SIZE = 32 # индексов (пользователей) на процесс
+SEARCH_MIN_QUERY_LENGTH = 3
+SEARCH_MAX_RESULTS = 50
+GZIP_COMPRESS_LEVEL = 6
+GZIP_MIMETYPES = {'text/html', 'text/css', 'application/json', 'application/javascript', 'text/javascript'}
+
+# --- Профилирование запросов (только по запросу администратора или для доли тяжелых запросов) ---
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get('ADMIN_EMAILS', '').split(',') if email.strip()}
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0)) # доля тяжелых запросов, 0 — выключено
+# Запросы к СДЭК выполняет планировщик этикеток в фоновых потоках: профиль get_cdek_labels_route показывает
+# нормализацию, постановку задачи и ожидание, но не время СДЭК (оно видно в логах LABEL_SCHEDULER)
+PROFILE_SAMPLED_ENDPOINTS = {'get_cdek_labels_route', 'download_ozon_excel', 'index'}
+PROFILE_REPORTS_DIR = os.environ.get('PROFILE_REPORTS_DIR', os.path.join(app.instance_path, 'profiles'))
+PROFILE_MAX_REPORTS = 50
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 15
+
+# --- Контроль допуска: лимиты одновременных тяжелых запросов (на один процесс gunicorn) ---
+# Сумма лимитов должна быть меньше --threads в Procfile, чтобы вход и настройки отвечали всегда
+ADMISSION_LIMITS = {
+    'ozon': int(os.environ.get('ADMISSION_OZON_SLOTS', 2)),
+    'labels': int(os.environ.get('ADMISSION_LABEL_SLOTS', 1)),
+    'reports': int(os.environ.get('ADMISSION_REPORT_SLOTS', 1)),
+}
+ADMISSION_RETRY_AFTER_SECONDS = {'ozon': 5, 'labels': 10, 'reports': 5}
+ADMISSION_ROUTE_CLASSES = {
+    'index': 'ozon',
+    'ozon_orders_json': 'ozon',
+    'download_ozon_excel': 'ozon',
+    'ozon_push': 'ozon', # awaiting_deliver дочитывает отправление из Ozon; на 503 Ozon повторит доставку
+    'get_cdek_labels_route': 'labels',
+    'download_label_job': 'labels',
+    'postings_report': 'reports',
+    'postings_report_json': 'reports',
+    'export_postings_report': 'reports',
+}
+
+# --- Circuit breaker для внешних API ---
+# Состояние хранится в процессе: каждый воркер gunicorn размыкает свои предохранители самостоятельно
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 3)) # подряд ошибок/таймаутов до размыкания
+CIRCUIT_OPEN_SECONDS = int(os.environ.get('CIRCUIT_OPEN_SECONDS', 60)) # сколько отказывать сразу, прежде чем пробовать снова
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') # без токена /metrics доступен только администраторам
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Вызов не выполнялся: предохранитель разомкнут. Наследуется от RequestException, чтобы
+    существующие обработчики ошибок сети обрабатывали его так же, но без ожидания таймаутов."""
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, upstream, account_key):
+        self.upstream = upstream
+        self.account_key = account_key
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.total_rejected = 0
+        self.opened_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def seconds_until_probe(self):
+        if self.state != self.OPEN:
+            return 0
+        return max(0, int(self.opened_at + CIRCUIT_OPEN_SECONDS - time.time()))
+
+    def retry_hint(self):
+        # Пока идет пробный запрос, срок повтора неизвестен — не обещаем «через 0 с»
+        if self.state == self.HALF_OPEN:
+            return "идет пробный запрос, повторите чуть позже"
+        seconds = self.seconds_until_probe()
+        if seconds > 0:
+            return f"повтор через {seconds} с"
+        return "следующий запрос будет пробным"
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= CIRCUIT_OPEN_SECONDS:
+                # Пропускаем один пробный запрос; остальные отказываются, пока он не завершится
+                self.state = self.HALF_OPEN
+                print(f"CIRCUIT: {self.upstream} [{self.account_key}] half-open, probing.")
+                return True
+            self.total_rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print(f"CIRCUIT: {self.upstream} [{self.account_key}] closed after successful probe.")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+
+    def record_failure(self, error):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            self.last_error = str(error)[:200]
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if self.state != self.OPEN:
+                    print(f"CIRCUIT: {self.upstream} [{self.account_key}] OPEN after {self.consecutive_failures} consecutive failure(s): {self.last_error}")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(upstream, account_key):
+    key = (upstream, str(account_key))
+    breaker = _circuit_breakers.get(key)
+    if breaker is None:
+        with _circuit_breakers_lock:
+            breaker = _circuit_breakers.setdefault(key, CircuitBreaker(upstream, str(account_key)))
+    return breaker
+
+def call_upstream(upstream, account_key, method, url, **kwargs):
+    """requests.post/get через предохранитель. Ошибками считаются сетевые сбои, таймауты, 5xx и 429."""
+    breaker = get_circuit_breaker(upstream, account_key)
+    if not breaker.allow_request():
+        raise CircuitOpenError(f"{upstream} временно недоступен (предохранитель разомкнут после серии ошибок), {breaker.retry_hint()}")
+    try:
+        response_obj = method(url, **kwargs)
+    except Exception as e:
+        # Любое исключение, а не только RequestException: иначе пробный запрос оставил бы предохранитель полуразомкнутым навсегда
+        breaker.record_failure(e)
+        raise
+    if response_obj.status_code >= 500 or response_obj.status_code == 429:
+        breaker.record_failure(f"HTTP {response_obj.status_code}")
+    else:
+        breaker.record_success()
+    return response_obj
+
+def get_open_circuits(account_keys):
+    """Разомкнутые/полуразомкнутые предохранители для указанных ключей аккаунтов (для отображения в UI)."""
+    wanted = {str(key) for key in account_keys}
+    return [b for b in list(_circuit_breakers.values()) if b.account_key in wanted and b.state != CircuitBreaker.CLOSED]
+
+def get_blocking_circuit(account_keys):
+    """Разомкнутый предохранитель по одному из ключей, для которого пробовать еще рано, или None."""
+    for breaker in get_open_circuits(account_keys):
+        if breaker.state == CircuitBreaker.OPEN and breaker.seconds_until_probe() > 0:
+            return breaker
+    return None
+
+def circuit_block_message(breaker):
+    return f"Сервис {breaker.upstream} временно недоступен (серия ошибок: {breaker.last_error}), {breaker.retry_hint()}."
+
+def get_user_circuit_keys():
+    shop = get_active_ozon_shop()
+    cdek_account = get_active_cdek_account()
+    keys = []
+    if shop:
+        keys.append(ozon_circuit_key(shop))
+    if cdek_account:
+        keys.append(cdek_circuit_key(cdek_account))
+    return keys
+
+def ozon_circuit_key(shop):
+    return f"ozon_shop_{shop.id}"
+
+def cdek_circuit_key(cdek_account):
+    return f"cdek_account_{cdek_account.id}"
 
 # --- Функции API (потребуют модификации для получения credentials) ---
 
+class DeadlineExceeded(Exception):
+    """Бюджет времени запроса исчерпан. print_uuid — уже созданная печатная форма СДЭК, опрос которой можно продолжить."""
+    def __init__(self, message="Истек бюджет времени запроса", print_uuid=None):
+        super().__init__(message)
+        self.print_uuid = print_uuid
+
+def deadline_timeout(deadline, default_timeout):
+    """Таймаут очередного вызова: не больше штатного и не дальше общего дедлайна (time.monotonic())."""
+    if deadline is None:
+        return default_timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    return min(default_timeout, remaining)
+
 def get_active_ozon_shop():
     if not current_user.is_authenticated:
         return None
@@ -87,15 +352,19 @@ def get_active_cdek_account():
         account = CdekAccount.query.filter_by(user_id=current_user.id).first()
     return account
 
-def get_cdek_access_token(): # Теперь использует активный аккаунт СДЭК
-    cdek_account = get_active_cdek_account()
+# Токены СДЭК кешируются в процессе (а не в сессии), чтобы ими могли пользоваться и фоновые задачи
+_cdek_token_cache = {}
+
+def get_cdek_access_token(cdek_account=None, deadline=None): # По умолчанию использует активный аккаунт СДЭК
+    if cdek_account is None:
+        cdek_account = get_active_cdek_account()
     if not cdek_account:
         print("CDEK Auth Error: No active CDEK account found for current user.")
         return None # Или возбуждать исключение/возвращать ошибку
 
-    # Используем ID аккаунта CDEK для уникальности ключа сессии токена
-    token_session_key = f'cdek_token_info_{cdek_account.id}'
-    token_info = session.get(token_session_key)
+    # ID аккаунта и client_id в ключе: при смене учетных данных старый токен не используется
+    token_cache_key = (cdek_account.id, cdek_account.client_id)
+    token_info = _cdek_token_cache.get(token_cache_key)
     
     if token_info and token_info['expires_at'] > time.time() + 60:
         return token_info['access_token']
@@ -107,12 +376,12 @@ def get_cdek_access_token(): # Теперь использует активны
     }
     response_obj = None
     try:
-        response_obj = requests.post(CDEK_TOKEN_URL, data=payload, timeout=10)
+        response_obj = call_upstream('cdek:token', cdek_circuit_key(cdek_account), requests.post, CDEK_TOKEN_URL, data=payload, timeout=deadline_timeout(deadline, 10))
         response_obj.raise_for_status()
         data = response_obj.json()
         access_token = data['access_token']
         expires_in = data.get('expires_in', 3600)
-        session[token_session_key] = {
+        _cdek_token_cache[token_cache_key] = {
             'access_token': access_token,
             'expires_at': time.time() + expires_in
         }
@@ -128,8 +397,156 @@ def get_cdek_access_token(): # Теперь использует активны
         print(err_msg)
         return None
 
-def process_cdek_label_request_for_chunk(track_numbers_chunk):
-    access_token = get_cdek_access_token()
+# --- Отметки о запрошенных этикетках (хранятся на сервере, общие для всех операторов) ---
+
+_last_label_request_purge_at = 0.0
+
+def get_requested_track_numbers(track_numbers, user_id):
+    """Возвращает множество треков из track_numbers, по которым этикетки уже запрашивались через аккаунты СДЭК
+    пользователя user_id (те же отметки, что сбрасывает clear_requested_labels)."""
+    unique_tracks = list({tn for tn in track_numbers if tn})
+    requested = set()
+    user_account_ids = db.session.query(CdekAccount.id).filter(CdekAccount.user_id == user_id)
+    # IN-запрос разбиваем на части, чтобы не упереться в лимит параметров SQLite
+    for i in range(0, len(unique_tracks), LABEL_REQUEST_LOOKUP_BATCH_SIZE):
+        batch = unique_tracks[i:i + LABEL_REQUEST_LOOKUP_BATCH_SIZE]
+        rows = db.session.query(LabelRequest.track_number).filter(
+            LabelRequest.track_number.in_(batch),
+            LabelRequest.cdek_account_id.in_(user_account_ids)
+        ).all()
+        requested.update(row[0] for row in rows)
+    return requested
+
+def record_label_requests(track_numbers, cdek_account, user_id):
+    unique_tracks = list(dict.fromkeys(tn for tn in track_numbers if tn))
+    if not unique_tracks:
+        return
+    now = datetime.utcnow()
+    existing = {}
+    for i in range(0, len(unique_tracks), LABEL_REQUEST_LOOKUP_BATCH_SIZE):
+        batch = unique_tracks[i:i + LABEL_REQUEST_LOOKUP_BATCH_SIZE]
+        for label_request in LabelRequest.query.filter(LabelRequest.cdek_account_id == cdek_account.id,
+                                                       LabelRequest.track_number.in_(batch)).all():
+            existing[label_request.track_number] = label_request
+    for tn in unique_tracks:
+        label_request = existing.get(tn)
+        if label_request:
+            label_request.requested_at = now
+            label_request.user_id = user_id
+        else:
+            db.session.add(LabelRequest(track_number=tn, cdek_account_id=cdek_account.id, user_id=user_id, requested_at=now))
+    db.session.commit()
+    print(f"LABEL_REQUESTS: Recorded {len(unique_tracks)} track(s) for CDEK account {cdek_account.account_name}.")
+    maybe_purge_expired_label_requests()
+
+def purge_expired_label_requests(retention_days=None):
+    """Удаляет отметки старше срока хранения. Возвращает количество удаленных записей."""
+    retention_days = retention_days if retention_days is not None else LABEL_REQUEST_RETENTION_DAYS
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    deleted = LabelRequest.query.filter(LabelRequest.requested_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    if deleted:
+        print(f"LABEL_REQUESTS: Purged {deleted} record(s) older than {retention_days} days.")
+    return deleted
+
+def maybe_purge_expired_label_requests():
+    # Чистка по индексу requested_at дешевая, но запускаем ее не чаще раза в час на воркер
+    global _last_label_request_purge_at
+    if time.time() - _last_label_request_purge_at < LABEL_REQUEST_PURGE_INTERVAL_SECONDS:
+        return
+    _last_label_request_purge_at = time.time()
+    purge_expired_label_requests()
+    expire_prefetched_labels()
+    purge_finished_label_jobs()
+    purge_rejected_tracks()
+    purge_stale_posting_states()
+
+# --- Нормализация запроса этикеток и негативный кэш отклоненных СДЭК треков ---
+
+def normalize_label_tracks(track_numbers, cdek_account, retry_rejected=False):
+    """Готовит треки к разбиению на пачки: убирает пустые и повторы (порядок сохраняется), проверяет формат,
+    откладывает недавно отклоненные СДЭК. Возвращает (треки для запроса, [{track, reason}] пропущенных)."""
+    tracks = []
+    skipped = []
+    seen = set()
+    for raw_track in track_numbers:
+        tn = raw_track.strip() if isinstance(raw_track, str) else ""
+        if not tn or tn in seen:
+            continue # Повторы — строки одного отправления с несколькими товарами
+        seen.add(tn)
+        if not CDEK_TRACK_NUMBER_PATTERN.match(tn):
+            skipped.append({"track": tn, "reason": "Неверный формат трек-номера"})
+            continue
+        tracks.append(tn)
+    if not retry_rejected:
+        rejected = get_rejected_tracks(cdek_account, tracks)
+        for tn in [tn for tn in tracks if tn in rejected]:
+            rejected_track = rejected[tn]
+            retry_at = rejected_track.rejected_at + timedelta(hours=REJECTED_TRACK_TTL_HOURS)
+            skipped.append({"track": tn, "reason": f"СДЭК отклонил трек {rejected_track.rejected_at.strftime('%d.%m %H:%M')} UTC "
+                                                   f"({(rejected_track.reason or 'без подробностей')[:200]}); повтор после {retry_at.strftime('%d.%m %H:%M')} UTC"})
+        tracks = [tn for tn in tracks if tn not in rejected]
+    return tracks, skipped
+
+def get_rejected_tracks(cdek_account, track_numbers):
+    """{трек: RejectedTrack} для треков, отклоненных СДЭК в пределах REJECTED_TRACK_TTL_HOURS."""
+    cutoff = datetime.utcnow() - timedelta(hours=REJECTED_TRACK_TTL_HOURS)
+    rejected = {}
+    for i in range(0, len(track_numbers), LABEL_REQUEST_LOOKUP_BATCH_SIZE):
+        batch = track_numbers[i:i + LABEL_REQUEST_LOOKUP_BATCH_SIZE]
+        for rejected_track in RejectedTrack.query.filter(RejectedTrack.cdek_account_id == cdek_account.id,
+                                                         RejectedTrack.track_number.in_(batch),
+                                                         RejectedTrack.rejected_at >= cutoff).all():
+            rejected[rejected_track.track_number] = rejected_track
+    return rejected
+
+def remember_rejected_tracks(cdek_account, reasons):
+    """reasons — {трек: причина} из ответа СДЭК."""
+    if not reasons:
+        return
+    now = datetime.utcnow()
+    existing = {r.track_number: r for r in RejectedTrack.query.filter(RejectedTrack.cdek_account_id == cdek_account.id,
+                                                                      RejectedTrack.track_number.in_(list(reasons))).all()}
+    for tn, reason in reasons.items():
+        rejected_track = existing.get(tn)
+        if rejected_track is None:
+            rejected_track = RejectedTrack(track_number=tn, cdek_account_id=cdek_account.id)
+            db.session.add(rejected_track)
+        rejected_track.reason = str(reason)[:500]
+        rejected_track.rejected_at = now
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback() # Тот же трек одновременно записал другой поток — отметка уже есть
+    print(f"REJECTED_TRACKS: Remembered {len(reasons)} track(s) rejected by CDEK for account {cdek_account.account_name}.")
+
+def forget_rejected_tracks(cdek_account, track_numbers):
+    # Трек, по которому СДЭК все-таки отдал этикетку, больше не считается отклоненным
+    deleted = RejectedTrack.query.filter(RejectedTrack.cdek_account_id == cdek_account.id,
+                                         RejectedTrack.track_number.in_(track_numbers)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def tracks_with_labels(cdek_account, track_numbers):
+    """Треки успешно полученной пачки без отклоненных СДЭК: их нет в PDF, и отметка "запрошена" была бы ложной."""
+    rejected = get_rejected_tracks(cdek_account, track_numbers)
+    return [tn for tn in track_numbers if tn not in rejected]
+
+def purge_rejected_tracks():
+    cutoff = datetime.utcnow() - timedelta(hours=REJECTED_TRACK_TTL_HOURS)
+    deleted = RejectedTrack.query.filter(RejectedTrack.rejected_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def process_cdek_label_request_for_chunk(track_numbers_chunk, cdek_account=None, deadline=None, print_uuid=None):
+    # deadline (time.monotonic()) ограничивает все шаги; по его истечении после создания печатной формы
+    # поднимается DeadlineExceeded с ее UUID, и следующий вызов с print_uuid продолжает опрос без повторной печати
+    if cdek_account is None:
+        cdek_account = get_active_cdek_account()
+    if not cdek_account:
+        return None, "No active CDEK account found."
+    circuit_key = cdek_circuit_key(cdek_account)
+    access_token = get_cdek_access_token(cdek_account, deadline)
     if not access_token:
         return None, f"Failed to get CDEK access token for chunk: {', '.join(track_numbers_chunk[:3])}..."
 
@@ -152,11 +569,17 @@ def process_cdek_label_request_for_chunk(track_numbers_chunk):
     }
     
     chunk_descriptor = track_numbers_chunk[0] if len(track_numbers_chunk) == 1 else f"{track_numbers_chunk[0]}... (total {len(track_numbers_chunk)})"
+    if print_uuid:
+        print(f"CDEK_BATCH_STEP1: Resuming chunk {chunk_descriptor} with existing Batch Print UUID: {print_uuid}")
+        # Отказы СДЭК по этой печатной форме записаны прошлой попыткой (ранее отклоненные треки в пачку не попадают)
+        rejected_in_print = set(get_rejected_tracks(cdek_account, track_numbers_chunk))
+        return poll_cdek_print_and_download(print_uuid, track_numbers_chunk, cdek_account, headers_json, headers_pdf, deadline,
+                                            rejected_in_print)
     print(f"CDEK_BATCH_STEP1: Requesting print generation for chunk starting with {chunk_descriptor} with {len(track_numbers_chunk)} orders. Format: A6.")
 
     response_obj_step1 = None
     try:
-        response_obj_step1 = requests.post(print_request_url, headers=headers_json, json=payload, timeout=30)
+        response_obj_step1 = call_upstream('cdek:print', circuit_key, requests.post, print_request_url, headers=headers_json, json=payload, timeout=deadline_timeout(deadline, 30))
         print(f"CDEK_BATCH_STEP1: Response status for chunk {chunk_descriptor}: {response_obj_step1.status_code}")
 
         if response_obj_step1.status_code == 202:
@@ -165,6 +588,7 @@ def process_cdek_label_request_for_chunk(track_numbers_chunk):
                 batch_print_request_uuid = response_data_step1["entity"]["uuid"]
                 print(f"CDEK_BATCH_STEP1: Print request accepted for chunk {chunk_descriptor}. Batch Print UUID: {batch_print_request_uuid}")
 
+                rejected = {}
                 if response_data_step1.get("requests") and isinstance(response_data_step1["requests"], list):
                     all_sub_requests_valid = True
                     for i, req_info in enumerate(response_data_step1["requests"]):
@@ -174,65 +598,14 @@ def process_cdek_label_request_for_chunk(track_numbers_chunk):
                         print(f"CDEK_BATCH_STEP1_SUB_INFO for {tn_for_log}: SubRequest_State: {state}, SubRequest_Errors: {errors}")
                         if state == 'INVALID' or errors:
                             all_sub_requests_valid = False
+                            if i < len(track_numbers_chunk):
+                                rejected[track_numbers_chunk[i]] = f"{state}: {errors}" if errors else str(state)
                     if not all_sub_requests_valid:
                          print(f"CDEK_BATCH_WARNING: One or more sub-requests in chunk {chunk_descriptor} were marked as INVALID or had errors by CDEK on initial POST.")
+                         remember_rejected_tracks(cdek_account, rejected)
 
-                print(f"CDEK_BATCH_STEP2: Polling for readiness of Batch Print UUID: {batch_print_request_uuid} (Chunk: {chunk_descriptor}).")
-                status_check_url = f"{CDEK_API_BASE_URL}/print/barcodes/{batch_print_request_uuid}"
-                
-                current_status_code = None # Инициализация current_status_code
-                for attempt in range(CDEK_POLLING_ATTEMPTS):
-                    print(f"CDEK_BATCH_STEP2: Polling attempt {attempt + 1}/{CDEK_POLLING_ATTEMPTS} for {batch_print_request_uuid}...")
-                    poll_response_obj = None
-                    try:
-                        poll_response_obj = requests.get(status_check_url, headers=headers_json, timeout=15)
-                        poll_response_obj.raise_for_status()
-                        poll_data = poll_response_obj.json()
-                        
-                        entity_statuses = poll_data.get("entity", {}).get("statuses", [])
-                        if entity_statuses and isinstance(entity_statuses, list):
-                            current_status_code = entity_statuses[-1].get("code")
-
-                        print(f"CDEK_BATCH_STEP2: Current status for {batch_print_request_uuid}: {current_status_code}")
-
-                        if current_status_code == "READY":
-                            print(f"CDEK_BATCH_STEP2: Batch {batch_print_request_uuid} is READY!")
-                            download_url = f"{CDEK_API_BASE_URL}/print/barcodes/{batch_print_request_uuid}.pdf"
-                            print(f"CDEK_BATCH_STEP3: Downloading PDF from {download_url} for chunk {chunk_descriptor}")
-                            response_obj_step3 = requests.get(download_url, headers=headers_pdf, timeout=60)
-                            
-                            print(f"CDEK_BATCH_STEP3: PDF download response status for {batch_print_request_uuid}: {response_obj_step3.status_code}")
-
-                            if response_obj_step3.status_code == 200 and 'application/pdf' in response_obj_step3.headers.get('Content-Type', '').lower():
-                                print(f"CDEK_BATCH_STEP3: Successfully fetched PDF for chunk {chunk_descriptor} (Batch UUID: {batch_print_request_uuid})")
-                                return response_obj_step3.content, None
-                            else:
-                                err_text_step3 = response_obj_step3.text[:200] if response_obj_step3.text else "No response text"
-                                error_message_step3 = f"Failed to download PDF for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid}). Status: {response_obj_step3.status_code}. Content-Type: {response_obj_step3.headers.get('Content-Type')}. Response: {err_text_step3}"
-                                print(error_message_step3)
-                                return None, error_message_step3
-                        
-                        elif current_status_code in ["INVALID", "REMOVED"]:
-                            error_msg_poll = f"Polling for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid}) failed. Status: {current_status_code}. Full statuses: {entity_statuses}"
-                            print(error_msg_poll)
-                            return None, error_msg_poll
-
-                    except requests.exceptions.HTTPError as e_poll:
-                        err_text_poll = e_poll.response.text[:200] if e_poll.response else "No poll response text"
-                        print(f"CDEK_BATCH_STEP2: HTTP error during polling attempt {attempt + 1} for {batch_print_request_uuid}: {e_poll.response.status_code} - {err_text_poll}. Retrying if attempts left.")
-                    except requests.exceptions.RequestException as e_poll_req:
-                        print(f"CDEK_BATCH_STEP2: Request exception during polling attempt {attempt + 1} for {batch_print_request_uuid}: {e_poll_req}. Retrying if attempts left.")
-                    except ValueError as e_poll_json: 
-                        resp_text_poll = poll_response_obj.text[:200] if poll_response_obj else "No poll response object"
-                        print(f"CDEK_BATCH_STEP2: JSON Decode Error during polling for {batch_print_request_uuid}: {e_poll_json}. Response: {resp_text_poll}. Retrying.")
-
-                    if attempt < CDEK_POLLING_ATTEMPTS - 1:
-                        time.sleep(CDEK_POLLING_INTERVAL_SECONDS)
-                    else: 
-                        timeout_error = f"Polling timeout for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid}). Status remained {current_status_code} after {CDEK_POLLING_ATTEMPTS} attempts."
-                        print(timeout_error)
-                        return None, timeout_error
-                return None, f"Polling loop ended unexpectedly for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid})."
+                return poll_cdek_print_and_download(batch_print_request_uuid, track_numbers_chunk, cdek_account, headers_json, headers_pdf, deadline,
+                                                    set(rejected))
 
             else: 
                 err_text_step1_json = response_obj_step1.text[:200]
@@ -246,11 +619,14 @@ def process_cdek_label_request_for_chunk(track_numbers_chunk):
             except: pass 
             
             error_details_msg = "No specific error details in JSON response."
+            rejected = {}
             if response_data_step1.get("requests") and isinstance(response_data_step1["requests"], list):
                 errors_from_requests = []
                 for req_idx, req_item in enumerate(response_data_step1["requests"]):
                     if req_item.get("errors"):
                         errors_from_requests.append(f"Order {track_numbers_chunk[req_idx] if req_idx < len(track_numbers_chunk) else req_idx}: {req_item.get('errors')}")
+                        if req_idx < len(track_numbers_chunk):
+                            rejected[track_numbers_chunk[req_idx]] = f"HTTP 400: {req_item.get('errors')}"
                 if errors_from_requests: error_details_msg = "Details from 'requests': " + "; ".join(errors_from_requests)
             elif response_data_step1.get("alerts") and isinstance(response_data_step1["alerts"], list): 
                  error_details_msg = "Details from 'alerts': " + str(response_data_step1["alerts"][:3]) 
@@ -260,6 +636,9 @@ def process_cdek_label_request_for_chunk(track_numbers_chunk):
             raw_text_preview = response_obj_step1.text[:200] if response_obj_step1.text else "No response text"
             error_message_step1 = f"CDEK Print Request (Step 1) HTTP 400 Error for chunk {chunk_descriptor}. {error_details_msg}. Raw: {raw_text_preview}"
             print(error_message_step1)
+            if not rejected and len(track_numbers_chunk) == 1:
+                rejected[track_numbers_chunk[0]] = f"HTTP 400: {error_details_msg}"
+            remember_rejected_tracks(cdek_account, rejected)
             return None, error_message_step1
         else: 
             err_text_step1 = response_obj_step1.text[:200]
@@ -268,6 +647,8 @@ def process_cdek_label_request_for_chunk(track_numbers_chunk):
             return None, error_message_step1
             
     except requests.exceptions.RequestException as e: 
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceeded(f"Истек бюджет времени запроса при создании печатной формы: {e}")
         error_msg = f"CDEK Print Request (Step 1) Request Error for chunk {chunk_descriptor}: {e}"
         if response_obj_step1 is not None: error_msg += f" | Response: {str(response_obj_step1.text)[:200]}"
         print(error_msg)
@@ -277,31 +658,566 @@ def process_cdek_label_request_for_chunk(track_numbers_chunk):
         print(f"CDEK Print Request (Step 1) JSON Decode Error for chunk {chunk_descriptor}: {e}. Response text: {resp_text}")
         return None, f"JSON decode error in print step 1 for chunk {chunk_descriptor}"
 
-def get_ozon_awaiting_deliver_orders(): # Теперь использует активный магазин Ozon
-    active_shop = get_active_ozon_shop()
-    if not active_shop:
-        msg = "Пожалуйста, сначала добавьте и/или выберите магазин Ozon в настройках аккаунта."
-        flash(msg, "warning")
-        return {"postings": [], "error": msg}, None, msg, 403
+def poll_cdek_print_and_download(batch_print_request_uuid, track_numbers_chunk, cdek_account, headers_json, headers_pdf, deadline=None,
+                                  rejected_in_print=None):
+    # rejected_in_print — треки, которые СДЭК отклонил при создании этой формы: в PDF их нет, отметку об отказе не снимаем
+    rejected_in_print = rejected_in_print or set()
+    circuit_key = cdek_circuit_key(cdek_account)
+    chunk_descriptor = track_numbers_chunk[0] if len(track_numbers_chunk) == 1 else f"{track_numbers_chunk[0]}... (total {len(track_numbers_chunk)})"
+    try:
+        print(f"CDEK_BATCH_STEP2: Polling for readiness of Batch Print UUID: {batch_print_request_uuid} (Chunk: {chunk_descriptor}).")
+        status_check_url = f"{CDEK_API_BASE_URL}/print/barcodes/{batch_print_request_uuid}"
+        
+        current_status_code = None # Инициализация current_status_code
+        for attempt in range(CDEK_POLLING_ATTEMPTS):
+            print(f"CDEK_BATCH_STEP2: Polling attempt {attempt + 1}/{CDEK_POLLING_ATTEMPTS} for {batch_print_request_uuid}...")
+            poll_response_obj = None
+            try:
+                poll_response_obj = call_upstream('cdek:print_status', circuit_key, requests.get, status_check_url, headers=headers_json, timeout=deadline_timeout(deadline, 15))
+                poll_response_obj.raise_for_status()
+                poll_data = poll_response_obj.json()
+                
+                entity_statuses = poll_data.get("entity", {}).get("statuses", [])
+                if entity_statuses and isinstance(entity_statuses, list):
+                    current_status_code = entity_statuses[-1].get("code")
+
+                print(f"CDEK_BATCH_STEP2: Current status for {batch_print_request_uuid}: {current_status_code}")
+
+                if current_status_code == "READY":
+                    print(f"CDEK_BATCH_STEP2: Batch {batch_print_request_uuid} is READY!")
+                    download_url = f"{CDEK_API_BASE_URL}/print/barcodes/{batch_print_request_uuid}.pdf"
+                    print(f"CDEK_BATCH_STEP3: Downloading PDF from {download_url} for chunk {chunk_descriptor}")
+                    response_obj_step3 = call_upstream('cdek:print_download', circuit_key, requests.get, download_url, headers=headers_pdf, timeout=deadline_timeout(deadline, 60))
+                    
+                    print(f"CDEK_BATCH_STEP3: PDF download response status for {batch_print_request_uuid}: {response_obj_step3.status_code}")
+
+                    if response_obj_step3.status_code == 200 and 'application/pdf' in response_obj_step3.headers.get('Content-Type', '').lower():
+                        print(f"CDEK_BATCH_STEP3: Successfully fetched PDF for chunk {chunk_descriptor} (Batch UUID: {batch_print_request_uuid})")
+                        forget_rejected_tracks(cdek_account, [tn for tn in track_numbers_chunk if tn not in rejected_in_print])
+                        return response_obj_step3.content, None
+                    else:
+                        err_text_step3 = response_obj_step3.text[:200] if response_obj_step3.text else "No response text"
+                        error_message_step3 = f"Failed to download PDF for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid}). Status: {response_obj_step3.status_code}. Content-Type: {response_obj_step3.headers.get('Content-Type')}. Response: {err_text_step3}"
+                        print(error_message_step3)
+                        return None, error_message_step3
+                
+                elif current_status_code in ["INVALID", "REMOVED"]:
+                    error_msg_poll = f"Polling for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid}) failed. Status: {current_status_code}. Full statuses: {entity_statuses}"
+                    print(error_msg_poll)
+                    if current_status_code == "INVALID" and len(track_numbers_chunk) == 1:
+                        # По пачке из одного трека виновник однозначен
+                        remember_rejected_tracks(cdek_account, {track_numbers_chunk[0]: f"печатная форма INVALID: {entity_statuses}"})
+                    return None, error_msg_poll
+
+            except CircuitOpenError as e_circuit:
+                # Не ждем оставшиеся попытки: СДЭК уже признан недоступным
+                error_msg_circuit = f"Polling for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid}) stopped: {e_circuit}"
+                print(error_msg_circuit)
+                return None, error_msg_circuit
+            except requests.exceptions.HTTPError as e_poll:
+                err_text_poll = e_poll.response.text[:200] if e_poll.response else "No poll response text"
+                print(f"CDEK_BATCH_STEP2: HTTP error during polling attempt {attempt + 1} for {batch_print_request_uuid}: {e_poll.response.status_code} - {err_text_poll}. Retrying if attempts left.")
+            except requests.exceptions.RequestException as e_poll_req:
+                print(f"CDEK_BATCH_STEP2: Request exception during polling attempt {attempt + 1} for {batch_print_request_uuid}: {e_poll_req}. Retrying if attempts left.")
+            except ValueError as e_poll_json: 
+                resp_text_poll = poll_response_obj.text[:200] if poll_response_obj else "No poll response object"
+                print(f"CDEK_BATCH_STEP2: JSON Decode Error during polling for {batch_print_request_uuid}: {e_poll_json}. Response: {resp_text_poll}. Retrying.")
+
+            if attempt < CDEK_POLLING_ATTEMPTS - 1:
+                time.sleep(deadline_timeout(deadline, CDEK_POLLING_INTERVAL_SECONDS))
+            else: 
+                timeout_error = f"Polling timeout for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid}). Status remained {current_status_code} after {CDEK_POLLING_ATTEMPTS} attempts."
+                print(timeout_error)
+                return None, timeout_error
+        return None, f"Polling loop ended unexpectedly for chunk {chunk_descriptor} (UUID: {batch_print_request_uuid})."
+    except DeadlineExceeded as e:
+        print(f"CDEK_BATCH_STEP2: Deadline reached while waiting for {batch_print_request_uuid} (Chunk: {chunk_descriptor}).")
+        raise DeadlineExceeded(str(e), print_uuid=batch_print_request_uuid)
+
+# --- Фоновая предзагрузка этикеток для новых отправлений ---
+
+_label_prefetch_executor = ThreadPoolExecutor(max_workers=LABEL_PREFETCH_MAX_WORKERS, thread_name_prefix='label-prefetch')
+
+def schedule_label_prefetch(cdek_account, track_numbers):
+    """Ставит в фоновую очередь этикетки для треков, которые еще не встречались. Возвращает число новых треков."""
+    unique_tracks = list(dict.fromkeys(tn for tn in track_numbers if tn))
+    known_tracks = set()
+    for i in range(0, len(unique_tracks), LABEL_REQUEST_LOOKUP_BATCH_SIZE):
+        batch = unique_tracks[i:i + LABEL_REQUEST_LOOKUP_BATCH_SIZE]
+        rows = db.session.query(PrefetchedLabel.track_number).filter(PrefetchedLabel.cdek_account_id == cdek_account.id,
+                                                                     PrefetchedLabel.track_number.in_(batch)).all()
+        known_tracks.update(row[0] for row in rows)
+    rejected_tracks = get_rejected_tracks(cdek_account, unique_tracks)
+    new_tracks = [tn for tn in unique_tracks if tn not in known_tracks and tn not in rejected_tracks][:LABEL_PREFETCH_MAX_TRACKS_PER_FETCH]
+    if not new_tracks:
+        return 0
+
+    for tn in new_tracks:
+        db.session.add(PrefetchedLabel(track_number=tn, cdek_account_id=cdek_account.id, status='pending'))
+    try:
+        db.session.commit()
+    except Exception as e:
+        # Те же треки мог одновременно поставить в очередь другой воркер (уникальный индекс)
+        db.session.rollback()
+        print(f"LABEL_PREFETCH: Could not enqueue {len(new_tracks)} track(s) for account {cdek_account.account_name}: {e}")
+        return 0
+
+    for i in range(0, len(new_tracks), LABEL_PREFETCH_BATCH_SIZE):
+        _label_prefetch_executor.submit(run_label_prefetch_batch, cdek_account.id, new_tracks[i:i + LABEL_PREFETCH_BATCH_SIZE])
+    print(f"LABEL_PREFETCH: Enqueued {len(new_tracks)} new track(s) for CDEK account {cdek_account.account_name}.")
+    return len(new_tracks)
+
+def run_label_prefetch_batch(cdek_account_id, track_numbers):
+    # Выполняется в фоновом потоке: свой контекст приложения, без current_user и сессии
+    with app.app_context():
+        try:
+            cdek_account = db.session.get(CdekAccount, cdek_account_id)
+            if not cdek_account:
+                return
+            slot_wait_until = time.monotonic() + LABEL_PREFETCH_SLOT_WAIT_SECONDS
+            batch_key = claim_prefetch_slot(cdek_account_id, track_numbers)
+            while batch_key is False:
+                if time.monotonic() > slot_wait_until:
+                    # Треки остаются pending и ставятся заново после LABEL_PREFETCH_RETRY_MINUTES
+                    print(f"LABEL_PREFETCH: Account {cdek_account.account_name} busy for {LABEL_PREFETCH_SLOT_WAIT_SECONDS}s, postponing batch.")
+                    return
+                time.sleep(LABEL_SCHEDULER_IDLE_SECONDS)
+                batch_key = claim_prefetch_slot(cdek_account_id, track_numbers)
+            if not batch_key:
+                return # Треки уже взяты другим воркером или удалены
+            labels = PrefetchedLabel.query.filter_by(batch_key=batch_key, status='running').order_by(PrefetchedLabel.id).all()
+            claimed_tracks = [label.track_number for label in labels]
+            # Одна печатная форма СДЭК на пачку; дедлайн ограничивает время в running, чтобы брошенную пачку можно было отличить
+            try:
+                pdf_content, error_label = process_cdek_label_request_for_chunk(claimed_tracks, cdek_account,
+                                                                                deadline=time.monotonic() + LABEL_CHUNK_DEADLINE_SECONDS)
+            except DeadlineExceeded:
+                pdf_content, error_label = None, f"СДЭК не подготовил этикетки за {LABEL_CHUNK_DEADLINE_SECONDS} с."
+            labeled_tracks = set(tracks_with_labels(cdek_account, claimed_tracks)) if pdf_content else set()
+            now = datetime.utcnow()
+            pdf_holder = None
+            for label in PrefetchedLabel.query.filter_by(batch_key=batch_key).order_by(PrefetchedLabel.id).all():
+                if label.track_number in labeled_tracks:
+                    label.status = 'ready'
+                    label.ready_at = now
+                    if pdf_holder is None:
+                        pdf_holder = label
+                        label.pdf_content = pdf_content
+                else:
+                    label.status = 'failed'
+                    label.error = (error_label or "СДЭК отклонил трек в пачке")[:500]
+            db.session.commit()
+            print(f"LABEL_PREFETCH: Batch of {len(claimed_tracks)} track(s) for account {cdek_account.account_name}: {len(labeled_tracks)} ready.")
+        except Exception as e:
+            db.session.rollback()
+            print(f"LABEL_PREFETCH: Batch for CDEK account ID {cdek_account_id} failed: {e}")
+
+def claim_prefetch_slot(cdek_account_id, track_numbers):
+    """Переводит ожидающие треки пачки предзагрузки в running под одним batch_key, если у аккаунта есть свободный слот
+    (общий лимит с планировщиком; пачка занимает один слот). Предзагрузка уступает пачкам пользователей:
+    пока для аккаунта есть очередь, слот не берется. Возвращает batch_key, False — аккаунт занят, None — ждущих треков нет."""
+    with _label_claim_lock:
+        if LabelJobChunk.query.filter_by(status='queued', cdek_account_id=cdek_account_id).first():
+            return False
+        if running_label_work_for_account(cdek_account_id) >= LABEL_MAX_RUNNING_CHUNKS_PER_ACCOUNT:
+            return False
+        batch_key = uuid.uuid4().hex
+        claimed = PrefetchedLabel.query.filter(PrefetchedLabel.cdek_account_id == cdek_account_id,
+                                               PrefetchedLabel.track_number.in_(track_numbers),
+                                               PrefetchedLabel.status == 'pending') \
+            .update({"status": "running", "batch_key": batch_key, "started_at": datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return None
+        # Другой воркер мог занять слот одновременно: предзагрузка отступает первой
+        if running_label_work_for_account(cdek_account_id) > LABEL_MAX_RUNNING_CHUNKS_PER_ACCOUNT:
+            PrefetchedLabel.query.filter_by(batch_key=batch_key, status='running') \
+                .update({"status": "pending", "batch_key": None, "started_at": None}, synchronize_session=False)
+            db.session.commit()
+            return False
+        return batch_key
+
+def take_prefetched_labels(cdek_account, track_numbers):
+    """Возвращает {(треки пачки): PDF} для готовых заранее пачек и отмечает их как напечатанные.
+    PDF пачки — одна печатная форма СДЭК на все ее треки, поэтому пачка отдается, только если выбраны
+    все ее готовые треки: иначе пользователь получил бы этикетки невыбранных заказов. Остальные треки
+    запрашиваются у СДЭК обычным порядком."""
+    unique_tracks = list(dict.fromkeys(tn for tn in track_numbers if tn))
+    wanted = set(unique_tracks)
+    ready_rows = []
+    for i in range(0, len(unique_tracks), LABEL_REQUEST_LOOKUP_BATCH_SIZE):
+        batch = unique_tracks[i:i + LABEL_REQUEST_LOOKUP_BATCH_SIZE]
+        ready_rows.extend(PrefetchedLabel.query.filter(PrefetchedLabel.cdek_account_id == cdek_account.id,
+                                                       PrefetchedLabel.status == 'ready',
+                                                       PrefetchedLabel.track_number.in_(batch)).all())
+    batches = defaultdict(list)
+    for label in ready_rows:
+        batches[label.batch_key or f"row-{label.id}"].append(label)
+    batch_keys = [key for key in batches if not key.startswith('row-')]
+    for i in range(0, len(batch_keys), LABEL_REQUEST_LOOKUP_BATCH_SIZE):
+        batch = batch_keys[i:i + LABEL_REQUEST_LOOKUP_BATCH_SIZE]
+        for label in PrefetchedLabel.query.filter(PrefetchedLabel.batch_key.in_(batch), PrefetchedLabel.status == 'ready').all():
+            if label.track_number not in wanted:
+                batches[label.batch_key].append(label)
+    ready = {}
+    now = datetime.utcnow()
+    for labels in batches.values():
+        if any(label.track_number not in wanted for label in labels):
+            continue
+        pdf_content = next((label.pdf_content for label in sorted(labels, key=lambda l: l.id) if label.pdf_content), None)
+        if not pdf_content:
+            continue
+        labels.sort(key=lambda l: l.id)
+        ready[tuple(label.track_number for label in labels)] = pdf_content
+        for label in labels:
+            label.printed_at = label.printed_at or now
+    if ready:
+        db.session.commit()
+    return ready
+
+def expire_prefetched_labels():
+    """Освобождает место от неиспользованных PDF и дает повторную попытку зависшим/неудачным трекам."""
+    now = datetime.utcnow()
+    expired = PrefetchedLabel.query.filter(PrefetchedLabel.status == 'ready',
+                                           PrefetchedLabel.created_at < now - timedelta(hours=LABEL_PREFETCH_TTL_HOURS)
+                                           ).update({"status": "expired", "pdf_content": None}, synchronize_session=False)
+    # Запись о треке остается как "уже виденный", чтобы он не запрашивался заново
+    retried = PrefetchedLabel.query.filter(PrefetchedLabel.status.in_(['pending', 'failed']),
+                                           PrefetchedLabel.created_at < now - timedelta(minutes=LABEL_PREFETCH_RETRY_MINUTES)
+                                           ).delete(synchronize_session=False)
+    # Пачку в работе сбрасываем только по времени взятия: пачка ограничена LABEL_CHUNK_DEADLINE_SECONDS, так что
+    # после LABEL_CHUNK_STALE_MINUTES ее бросил упавший воркер и повторная печать не задвоит этикетки
+    retried += PrefetchedLabel.query.filter(PrefetchedLabel.status == 'running',
+                                            db.or_(PrefetchedLabel.started_at.is_(None),
+                                                   PrefetchedLabel.started_at < now - timedelta(minutes=LABEL_CHUNK_STALE_MINUTES))
+                                            ).delete(synchronize_session=False)
+    purged = PrefetchedLabel.query.filter(PrefetchedLabel.created_at < now - timedelta(days=LABEL_REQUEST_RETENTION_DAYS)
+                                          ).delete(synchronize_session=False)
+    db.session.commit()
+    if expired or retried or purged:
+        print(f"LABEL_PREFETCH: Expired {expired} unused label(s), reset {retried} pending/failed/abandoned, purged {purged} old record(s).")
+    return expired
+
+# --- Планировщик этикеток: очередь пачек с лимитами на пользователя и аккаунт ---
+# Запрос пользователя не держит воркер gunicorn: задача режется на пачки, пачки берут в работу
+# фоновые потоки по кругу между пользователями, клиент опрашивает статус и место в очереди.
+
+_label_scheduler_lock = threading.Lock()
+_label_claim_lock = threading.Lock()
+_label_scheduler_threads = []
+
+def running_prefetch_per_account():
+    # Предзагрузка этикеток занимает те же слоты аккаунта СДЭК, что и пачки планировщика: одна пачка — один слот
+    rows = db.session.query(PrefetchedLabel.cdek_account_id, PrefetchedLabel.batch_key, PrefetchedLabel.id).filter_by(status='running').all()
+    return Counter(account_id for account_id, _ in {(account_id, batch_key or f"row-{label_id}") for account_id, batch_key, label_id in rows})
+
+def running_label_work_for_account(cdek_account_id):
+    return (LabelJobChunk.query.filter_by(status='running', cdek_account_id=cdek_account_id).count()
+            + running_prefetch_per_account()[cdek_account_id])
+
+def ensure_label_scheduler_started():
+    with _label_scheduler_lock:
+        alive = [t for t in _label_scheduler_threads if t.is_alive()]
+        for i in range(len(alive), LABEL_SCHEDULER_THREADS):
+            thread = threading.Thread(target=label_scheduler_loop, name=f'label-scheduler-{i}', daemon=True)
+            thread.start()
+            alive.append(thread)
+        _label_scheduler_threads[:] = alive
+
+def label_scheduler_loop():
+    # Поток живет, пока в очереди есть пачки; новые задачи и опрос статуса запускают его снова
+    while True:
+        chunk_id = None
+        with app.app_context():
+            try:
+                chunk_id = claim_next_label_chunk()
+                if chunk_id:
+                    run_label_chunk(chunk_id)
+                elif not LabelJobChunk.query.filter_by(status='queued').first():
+                    return
+            except Exception as e:
+                db.session.rollback()
+                print(f"LABEL_SCHEDULER: Error while processing chunk {chunk_id}: {e}")
+        if not chunk_id:
+            time.sleep(LABEL_SCHEDULER_IDLE_SECONDS)
+
+def claim_next_label_chunk():
+    """Атомарно переводит следующую по очереди пачку в running и возвращает ее id (или None)."""
+    with _label_claim_lock:
+        now = datetime.utcnow()
+        requeued = LabelJobChunk.query.filter(LabelJobChunk.status == 'running',
+                                              LabelJobChunk.started_at < now - timedelta(minutes=LABEL_CHUNK_STALE_MINUTES)
+                                              ).update({"status": "queued", "started_at": None}, synchronize_session=False)
+        if requeued:
+            db.session.commit()
+            print(f"LABEL_SCHEDULER: Requeued {requeued} stale chunk(s).")
+
+        running = db.session.query(LabelJobChunk.user_id, LabelJobChunk.cdek_account_id).filter_by(status='running').all()
+        running_per_user = Counter(row[0] for row in running)
+        running_per_account = Counter(row[1] for row in running) + running_prefetch_per_account()
+        queued_users = [row[0] for row in db.session.query(LabelJobChunk.user_id).filter_by(status='queued').distinct().all()]
+        candidate_users = [u for u in queued_users if running_per_user[u] < LABEL_MAX_RUNNING_CHUNKS_PER_USER]
+        if not candidate_users:
+            return None
+
+        # Круговой обход: первым обслуживается пользователь, который дольше всех не получал пачку
+        last_served = dict(db.session.query(LabelJobChunk.user_id, db.func.max(LabelJobChunk.started_at))
+                           .filter(LabelJobChunk.user_id.in_(candidate_users))
+                           .group_by(LabelJobChunk.user_id).all())
+        candidate_users.sort(key=lambda u: (last_served.get(u) or datetime.min, u))
+        busy_accounts = [a for a, n in running_per_account.items() if n >= LABEL_MAX_RUNNING_CHUNKS_PER_ACCOUNT]
+
+        for user_id in candidate_users:
+            query = LabelJobChunk.query.filter_by(status='queued', user_id=user_id)
+            if busy_accounts:
+                query = query.filter(~LabelJobChunk.cdek_account_id.in_(busy_accounts))
+            chunk = query.order_by(LabelJobChunk.id).first()
+            if not chunk:
+                continue
+            claimed = LabelJobChunk.query.filter_by(id=chunk.id, status='queued').update(
+                {"status": "running", "started_at": now}, synchronize_session=False)
+            db.session.commit()
+            if claimed and label_chunk_within_limits(chunk.id, chunk.user_id, chunk.cdek_account_id):
+                return chunk.id
+        return None
 
-    client_id = active_shop.client_id
-    api_key = active_shop.api_key
-    warehouse_name_filter = active_shop.warehouse_name if active_shop.warehouse_name else "rFBS"
+def label_chunk_within_limits(chunk_id, user_id, cdek_account_id):
+    # Блокировка выше действует только внутри процесса: если другой воркер gunicorn занял слот
+    # одновременно с нами, лишняя (более поздняя) пачка возвращается в очередь
+    account_limit = LABEL_MAX_RUNNING_CHUNKS_PER_ACCOUNT - running_prefetch_per_account()[cdek_account_id]
+    for column, value, limit in ((LabelJobChunk.user_id, user_id, LABEL_MAX_RUNNING_CHUNKS_PER_USER),
+                                 (LabelJobChunk.cdek_account_id, cdek_account_id, account_limit)):
+        allowed_ids = [row[0] for row in db.session.query(LabelJobChunk.id)
+                       .filter(LabelJobChunk.status == 'running', column == value)
+                       .order_by(LabelJobChunk.started_at, LabelJobChunk.id).limit(max(0, limit)).all()]
+        if chunk_id not in allowed_ids:
+            LabelJobChunk.query.filter_by(id=chunk_id, status='running').update(
+                {"status": "queued", "started_at": None}, synchronize_session=False)
+            db.session.commit()
+            return False
+    return True
+
+def run_label_chunk(chunk_id):
+    chunk = db.session.get(LabelJobChunk, chunk_id)
+    if not chunk:
+        return # Задачу удалили вместе с аккаунтом
+    job = chunk.job
+    if job.status == 'queued':
+        job.status = 'running'
+        db.session.commit()
+    track_numbers = json.loads(chunk.track_numbers)
+    cdek_account = db.session.get(CdekAccount, chunk.cdek_account_id)
+    print(f"LABEL_SCHEDULER: Job {job.id} chunk {chunk.chunk_index + 1}/{len(job.chunks)} ({len(track_numbers)} orders), user ID {chunk.user_id}.")
+    chunk.attempts = (chunk.attempts or 0) + 1
+    db.session.commit()
+    if cdek_account:
+        try:
+            pdf_content, error_label = process_cdek_label_request_for_chunk(track_numbers, cdek_account,
+                                                                            deadline=time.monotonic() + LABEL_CHUNK_DEADLINE_SECONDS,
+                                                                            print_uuid=chunk.print_uuid)
+        except DeadlineExceeded as e:
+            if chunk.attempts < LABEL_CHUNK_MAX_ATTEMPTS:
+                # Пачка возвращается в общую очередь (поток достается следующему по кругу) и продолжит с той же печатной формы
+                chunk.print_uuid = e.print_uuid or chunk.print_uuid
+                chunk.status = 'queued'
+                chunk.started_at = None
+                db.session.commit()
+                print(f"LABEL_SCHEDULER: Job {job.id} chunk {chunk.chunk_index + 1} requeued after deadline (attempt {chunk.attempts}).")
+                return
+            pdf_content, error_label = None, f"СДЭК не подготовил этикетки за {chunk.attempts} попытки по {LABEL_CHUNK_DEADLINE_SECONDS} с."
+    else:
+        pdf_content, error_label = None, "Аккаунт СДЭК удален"
+
+    chunk.finished_at = datetime.utcnow()
+    if pdf_content:
+        chunk.status = 'done'
+        chunk.pdf_content = pdf_content
+    else:
+        chunk.status = 'failed'
+        chunk.error = (error_label or "Не удалось получить PDF для пачки по неизвестной причине.")[:500]
+    db.session.commit()
+    if pdf_content:
+        record_label_requests(tracks_with_labels(cdek_account, track_numbers), cdek_account, chunk.user_id)
+    finalize_label_job(job)
+
+def finalize_label_job(job):
+    statuses = [c.status for c in job.chunks]
+    if any(st in ('queued', 'running') for st in statuses):
+        return
+    if all(st == 'done' for st in statuses):
+        job.status = 'done'
+    elif any(st == 'done' for st in statuses):
+        job.status = 'partial'
+    else:
+        job.status = 'failed'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    print(f"LABEL_SCHEDULER: Job {job.id} finished with status {job.status}.")
+
+def create_label_job(cdek_account, user_id, chunks, ready_labels, failed_chunks, skipped_tracks=None):
+    """Создает задачу: ready_labels — {(треки): PDF} уже готовых этикеток, failed_chunks — [(треки, ошибка)]."""
+    job = LabelJob(id=uuid.uuid4().hex, user_id=user_id, cdek_account_id=cdek_account.id, status='queued',
+                   skipped_tracks=json.dumps(skipped_tracks, ensure_ascii=False) if skipped_tracks else None)
+    db.session.add(job)
+    now = datetime.utcnow()
+    chunk_index = 0
+    for tracks, pdf_content in ready_labels.items():
+        db.session.add(LabelJobChunk(job=job, chunk_index=chunk_index, user_id=user_id, cdek_account_id=cdek_account.id,
+                                     track_numbers=json.dumps(list(tracks)), status='done', pdf_content=pdf_content,
+                                     started_at=now, finished_at=now))
+        chunk_index += 1
+    for tracks, error in failed_chunks:
+        db.session.add(LabelJobChunk(job=job, chunk_index=chunk_index, user_id=user_id, cdek_account_id=cdek_account.id,
+                                     track_numbers=json.dumps(tracks), status='failed', error=error, finished_at=now))
+        chunk_index += 1
+    for tracks in chunks:
+        db.session.add(LabelJobChunk(job=job, chunk_index=chunk_index, user_id=user_id, cdek_account_id=cdek_account.id,
+                                     track_numbers=json.dumps(tracks), status='queued'))
+        chunk_index += 1
+    db.session.commit()
+    return job
 
-    print(f"Fetching Ozon orders for shop: {active_shop.shop_name} (User ID: {current_user.id}), Warehouse: {warehouse_name_filter}")
-    all_postings_data = []
+def label_job_queue_position(job):
+    """Сколько пачек будет взято в работу раньше первой ожидающей пачки задачи (0 — следующая на очереди)."""
+    first_queued = LabelJobChunk.query.filter_by(job_id=job.id, status='queued').order_by(LabelJobChunk.id).first()
+    if not first_queued:
+        return None
+    own_ahead = LabelJobChunk.query.filter(LabelJobChunk.status == 'queued', LabelJobChunk.user_id == job.user_id,
+                                           LabelJobChunk.id < first_queued.id).count()
+    # При круговом обходе каждый другой пользователь успеет получить не больше own_ahead + 1 пачек
+    queued_per_user = db.session.query(LabelJobChunk.user_id, db.func.count(LabelJobChunk.id)) \
+        .filter(LabelJobChunk.status == 'queued', LabelJobChunk.user_id != job.user_id) \
+        .group_by(LabelJobChunk.user_id).all()
+    return own_ahead + sum(min(count, own_ahead + 1) for _, count in queued_per_user)
+
+def describe_label_chunk(track_numbers):
+    return track_numbers[0] if len(track_numbers) == 1 else f"chunk starting with {track_numbers[0]} ({len(track_numbers)} orders)"
+
+def label_job_status_payload(job):
+    counts = Counter(c.status for c in job.chunks)
+    errors = [{"ozon_track_chunk": describe_label_chunk(json.loads(c.track_numbers)),
+               "error": f"Ошибка получения этикеток для пачки: {c.error}"}
+              for c in job.chunks if c.status == 'failed']
+    finished = job.status in ('done', 'partial', 'failed')
+    payload = {
+        "success": job.status != 'failed',
+        "job_id": job.id,
+        "status": job.status,
+        "total_chunks": len(job.chunks),
+        "done_chunks": counts['done'],
+        "failed_chunks": counts['failed'],
+        "running_chunks": counts['running'],
+        "queue_position": None if finished else label_job_queue_position(job),
+        "errors": errors,
+        "skipped": json.loads(job.skipped_tracks) if job.skipped_tracks else [],
+        "status_url": url_for('label_job_status', job_id=job.id),
+        "download_url": url_for('download_label_job', job_id=job.id),
+    }
+    ready_tracks = [tn for c in job.chunks if c.status == 'done' and not c.delivered_at for tn in json.loads(c.track_numbers)]
+    payload["ready_tracks"] = ready_tracks
+    if ready_tracks and not finished:
+        # Готовые пачки можно забрать, не дожидаясь остальных
+        payload["ready_download_url"] = payload["download_url"]
+    if finished:
+        payload["requested_tracks"] = [tn for c in job.chunks if c.status == 'done' for tn in json.loads(c.track_numbers)]
+    return payload
+
+def wait_for_label_job(job, deadline):
+    """Ждет завершения задачи до дедлайна (time.monotonic()); возвращает True, если задача завершилась."""
+    while True:
+        db.session.expire_all()
+        if job.status not in ('queued', 'running'):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(LABEL_JOB_WAIT_POLL_SECONDS, remaining))
+
+def request_deadline(data):
+    # Клиент может попросить более короткий бюджет, но не длиннее серверного
+    # 0 — допустимое значение (только то, что уже готово), поэтому проверяем именно None
+    requested = LABEL_REQUEST_DEADLINE_SECONDS
+    raw = data.get('deadline_seconds')
+    try:
+        if raw is not None:
+            requested = float(raw)
+    except (TypeError, ValueError):
+        pass
+    if requested != requested:  # NaN
+        requested = LABEL_REQUEST_DEADLINE_SECONDS
+    return time.monotonic() + max(0.0, min(requested, LABEL_REQUEST_DEADLINE_SECONDS))
+
+def purge_finished_label_jobs():
+    cutoff = datetime.utcnow() - timedelta(hours=LABEL_JOB_RETENTION_HOURS)
+    old_job_ids = [row[0] for row in db.session.query(LabelJob.id).filter(LabelJob.created_at < cutoff).all()]
+    for i in range(0, len(old_job_ids), LABEL_REQUEST_LOOKUP_BATCH_SIZE):
+        batch = old_job_ids[i:i + LABEL_REQUEST_LOOKUP_BATCH_SIZE]
+        LabelJobChunk.query.filter(LabelJobChunk.job_id.in_(batch)).delete(synchronize_session=False)
+        LabelJob.query.filter(LabelJob.id.in_(batch)).delete(synchronize_session=False)
+    db.session.commit()
+    if old_job_ids:
+        print(f"LABEL_SCHEDULER: Purged {len(old_job_ids)} label job(s) older than {LABEL_JOB_RETENTION_HOURS} hours.")
+    return len(old_job_ids)
+
+def build_grouped_posting(posting, warehouse_name_filter):
+    """Отправление Ozon в формате grouped_postings или None, если оно не подходит (другой склад, нет трека)."""
+    delivery_method = posting.get("delivery_method", {})
+    warehouse_value_from_api = delivery_method.get("warehouse", "")
+    if warehouse_value_from_api != warehouse_name_filter:
+        return None
+    
+    ozon_tracking_number = posting.get("tracking_number", "")
+    if not ozon_tracking_number:
+        print(f"OZON_LIST: Skipping posting {posting.get('posting_number')} as it has no tracking_number for CDEK.")
+        return None
+
+    order_date_str = ""
+    if posting.get("in_process_at"):
+        try:
+            dt_obj = datetime.fromisoformat(posting["in_process_at"].replace("Z", "+00:00"))
+            order_date_str = dt_obj.strftime("%d.%m.%Y")
+        except ValueError:
+            order_date_str = posting["in_process_at"]
+
+    return {
+        "posting_number": posting.get("posting_number", ""),
+        "order_date": order_date_str,
+        "track_number": ozon_tracking_number,
+        "warehouse": warehouse_value_from_api,
+        "big_digits": ozon_tracking_number[-4:] if ozon_tracking_number else "",
+        "products": [
+            {
+                "offer_id": product.get("offer_id", ""),
+                "name": product.get("name", ""),
+                "quantity": product.get("quantity", 0)
+            }
+            for product in posting.get("products", [])
+        ]
+    }
+
+def ozon_headers(shop):
+    return {
+        "Client-Id": shop.client_id,
+        "Api-Key": shop.api_key,
+        "Content-Type": "application/json"
+    }
+
+def fetch_ozon_awaiting_postings(shop):
+    """Полная выгрузка отправлений awaiting_deliver магазина. Возвращает (grouped_postings, error, fetch_ok):
+    fetch_ok=False, если выгрузка прервалась из-за ошибки API и список может быть неполным."""
+    warehouse_name_filter = shop.warehouse_name if shop.warehouse_name else "rFBS"
+
+    print(f"Fetching Ozon orders for shop: {shop.shop_name} (User ID: {shop.user_id}), Warehouse: {warehouse_name_filter}")
+    grouped_postings = []
     offset = 0
     limit = 100 
     now = datetime.now()
     since = (now - timedelta(days=30)).isoformat() + "Z"
     to = now.isoformat() + "Z"
 
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": api_key,
-        "Content-Type": "application/json"
-    }
+    headers = ozon_headers(shop)
     current_error = None
+    fetch_ok = True
 
     while True:
         payload = {
@@ -312,74 +1228,852 @@ def get_ozon_awaiting_deliver_orders(): # Теперь использует ак
         }
         response_obj = None
         try:
-            response_obj = requests.post(OZON_FBS_LIST_URL, headers=headers, json=payload, timeout=10)
+            response_obj = call_upstream('ozon:fbs_list', ozon_circuit_key(shop), requests.post, OZON_FBS_LIST_URL, headers=headers, json=payload, timeout=10)
             response_obj.raise_for_status()
             data_from_ozon = response_obj.json()
         except requests.exceptions.HTTPError as e:
             err_text = e.response.text[:200] if e.response else ""
-            current_error = f"OZON_LIST HTTP Error for shop {active_shop.shop_name}: {e.response.status_code} - {err_text}"
+            current_error = f"OZON_LIST HTTP Error for shop {shop.shop_name}: {e.response.status_code} - {err_text}"
             print(current_error)
+            fetch_ok = False
             break
         except requests.exceptions.RequestException as e:
-            current_error = f"OZON_LIST Request Exception for shop {active_shop.shop_name}: {e}"
+            current_error = f"OZON_LIST Request Exception for shop {shop.shop_name}: {e}"
             print(current_error)
+            fetch_ok = False
             break
         except Exception as e: 
-            current_error = f"OZON_LIST General Error for shop {active_shop.shop_name}: {str(e)}"
+            current_error = f"OZON_LIST General Error for shop {shop.shop_name}: {str(e)}"
             print(current_error)
+            fetch_ok = False
             break
         
         postings = data_from_ozon.get("result", {}).get("postings", [])
         if not postings:
-            if offset == 0 and not all_postings_data and not current_error:
-                current_error = f"OZON_LIST: No orders found for shop {active_shop.shop_name} or unexpected API response."
+            if offset == 0 and not grouped_postings and not current_error:
+                current_error = f"OZON_LIST: No orders found for shop {shop.shop_name} or unexpected API response."
             break
 
         for posting in postings:
-            delivery_method = posting.get("delivery_method", {})
-            warehouse_value_from_api = delivery_method.get("warehouse", "")
-            if warehouse_value_from_api != warehouse_name_filter:
-                continue
-            
-            ozon_tracking_number = posting.get("tracking_number", "")
-            if not ozon_tracking_number:
-                print(f"OZON_LIST: Skipping posting {posting.get('posting_number')} as it has no tracking_number for CDEK.")
-                continue
-
-            order_date_str = ""
-            if posting.get("in_process_at"):
-                try:
-                    dt_obj = datetime.fromisoformat(posting["in_process_at"].replace("Z", "+00:00"))
-                    order_date_str = dt_obj.strftime("%d.%m.%Y")
-                except ValueError:
-                    order_date_str = posting["in_process_at"]
-
-            for product in posting.get("products", []):
-                all_postings_data.append({
-                    "Магазин": active_shop.shop_name,
-                    "Дата заказа": order_date_str,
-                    "Номер отправления": posting.get("posting_number", ""),
-                    "Артикул": product.get("offer_id", ""),
-                    "Наименование товара": product.get("name", ""),
-                    "Количество": product.get("quantity", 0),
-                    "Трек-номер": ozon_tracking_number, 
-                    "Склад": warehouse_value_from_api,
-                    "4 Большие цифры": ozon_tracking_number[-4:] if ozon_tracking_number else ""
-                })
+            grouped_posting = build_grouped_posting(posting, warehouse_name_filter)
+            if grouped_posting:
+                grouped_postings.append(grouped_posting)
         
         if len(postings) < limit: break
         offset += limit
 
-    if not all_postings_data and not current_error:
+    return grouped_postings, current_error, fetch_ok
+
+def get_ozon_awaiting_deliver_orders(force_refresh=False): # Теперь использует активный магазин Ozon
+    active_shop = get_active_ozon_shop()
+    if not active_shop:
+        msg = "Пожалуйста, сначала добавьте и/или выберите магазин Ozon в настройках аккаунта."
+        flash(msg, "warning")
+        return {"grouped_postings": [], "error": msg}, None, msg, 403
+
+    warehouse_name_filter = active_shop.warehouse_name if active_shop.warehouse_name else "rFBS"
+    if not force_refresh and wait_for_orders_warmup(active_shop):
+        db.session.refresh(active_shop) # прогрев сохранял состояние в своей сессии
+    if not force_refresh and claim_orders_cache(active_shop):
+        grouped_postings = load_cached_postings(active_shop)
+        current_error = None
+        print(f"OZON: Served {len(grouped_postings)} posting(s) for shop {active_shop.shop_name} from stored state (synced at {active_shop.orders_synced_at}).")
+    else:
+        grouped_postings, current_error = sync_shop_postings(active_shop)
+
+    if not grouped_postings and not current_error:
         current_error = f"OZON_LIST: No 'awaiting_deliver' orders found for warehouse '{warehouse_name_filter}' in shop '{active_shop.shop_name}' within 30 days."
     
-    if all_postings_data:
-        all_postings_data.sort(key=lambda x: x["4 Большие цифры"])
-        print(f"OZON: Processing done for shop {active_shop.shop_name}. Total items: {len(all_postings_data)}")
-        return {"postings": all_postings_data, "error": current_error}, active_shop.shop_name, current_error, 200
+    if grouped_postings:
+        grouped_postings.sort(key=lambda x: x["big_digits"])
+        duplicate_tracks = group_duplicate_tracks(grouped_postings)
+        requested_tracks = get_requested_track_numbers((p["track_number"] for p in grouped_postings), active_shop.user_id)
+        for posting in grouped_postings:
+            posting["label_requested"] = posting["track_number"] in requested_tracks
+            posting["duplicate_track"] = posting["track_number"] in duplicate_tracks
+        if active_shop.label_prefetch_account:
+            schedule_label_prefetch(active_shop.label_prefetch_account,
+                                    [p["track_number"] for p in grouped_postings if not p["label_requested"]])
+        total_items = sum(len(p["products"]) for p in grouped_postings)
+        print(f"OZON: Processing done for shop {active_shop.shop_name}. Postings: {len(grouped_postings)}, total items: {total_items}, duplicate tracks: {len(duplicate_tracks)}")
+        return {"grouped_postings": grouped_postings, "duplicate_tracks": duplicate_tracks, "error": current_error}, active_shop.shop_name, current_error, 200
+    else:
+        return {"grouped_postings": [], "error": current_error if current_error else "Нет данных для отображения"}, active_shop.shop_name, current_error if current_error else "Нет данных для отображения", 200 if not current_error else 404
+
+# --- Сохраненное состояние отправлений (полная сверка + push-уведомления Ozon) ---
+
+def orders_cache_within_ttl(shop):
+    if not shop.orders_synced_at:
+        return False
+    # С push-уведомлениями состояние актуально между сверками; без них — только короткий TTL
+    max_age = ORDERS_PUSH_RECONCILE_SECONDS if shop.push_token else ORDERS_CACHE_TTL_SECONDS
+    return (datetime.utcnow() - shop.orders_synced_at).total_seconds() < max_age
+
+def shop_orders_cache_is_fresh(shop):
+    # Непоказанный прогрев тоже считается свежим: повторно выгружать магазин до первого показа незачем
+    if shop.orders_synced_at and shop.orders_warmed_until and datetime.utcnow() < shop.orders_warmed_until:
+        return True
+    return orders_cache_within_ttl(shop)
+
+def claim_orders_cache(shop):
+    """Можно ли показать сохраненное состояние. Прогретое состояние отдается в обход TTL только один раз —
+    при первом показе после прогрева; дальше снова действует обычный TTL (в том числе ORDERS_CACHE_TTL_SECONDS=0)."""
+    fresh = orders_cache_within_ttl(shop)
+    warmed_until = shop.orders_warmed_until
+    if shop.orders_synced_at and warmed_until:
+        # Снимаем отметку условным UPDATE: из параллельных запросов (и воркеров) ее получит только один
+        claimed = OzonShop.query.filter_by(id=shop.id, orders_warmed_until=warmed_until).update(
+            {'orders_warmed_until': None}, synchronize_session=False)
+        db.session.commit()
+        fresh = fresh or (claimed == 1 and datetime.utcnow() < warmed_until)
+    return fresh
+
+def load_cached_postings(shop):
+    states = OzonPostingState.query.filter_by(shop_id=shop.id, status='awaiting_deliver').all()
+    return [json.loads(state.data) for state in states if state.data]
+
+def sync_shop_postings(shop, fetched=None, warmed_until=None):
+    """Полная выгрузка из Ozon и сверка сохраненного состояния. Возвращает (grouped_postings, error).
+    fetched — уже готовый результат fetch_ozon_awaiting_postings (прогрев магазинов с общими учетными данными)."""
+    grouped_postings, current_error, fetch_ok = fetched if fetched else fetch_ozon_awaiting_postings(shop)
+    if not fetch_ok:
+        return grouped_postings, current_error # Неполные данные не сохраняем
+    for attempt in range(1, POSTING_SYNC_MAX_ATTEMPTS + 1):
+        try:
+            store_shop_postings(shop, grouped_postings, warmed_until)
+            break
+        except IntegrityError as e:
+            # Параллельная сверка того же магазина (прогрев, другой воркер) уже добавила эти отправления — повторяем поверх ее записей
+            db.session.rollback()
+            if attempt == POSTING_SYNC_MAX_ATTEMPTS:
+                # Выгрузка все равно отдается пользователю; состояние сохранит следующая сверка
+                print(f"OZON_SYNC: Shop {shop.shop_name}: giving up storing postings after {attempt} concurrent-sync conflict(s): {e.orig}")
+                return grouped_postings, current_error
+    archive_pending_postings(shop)
+    return grouped_postings, current_error
+
+def store_shop_postings(shop, grouped_postings, warmed_until=None):
+    now = datetime.utcnow()
+    fetched = {p["posting_number"]: p for p in grouped_postings}
+    existing = {state.posting_number: state for state in OzonPostingState.query.filter_by(shop_id=shop.id).all()}
+    returned = [] # архивные отправления, снова ожидающие отгрузки: прежнее событие статуса больше не последнее
+    for posting_number, posting in fetched.items():
+        state = existing.get(posting_number)
+        if state is None:
+            state = OzonPostingState(shop_id=shop.id, posting_number=posting_number)
+            db.session.add(state)
+        elif state.archived_at and state.status != 'awaiting_deliver':
+            returned.append(posting_number)
+        state.status = 'awaiting_deliver'
+        state.data = json.dumps(posting, ensure_ascii=False)
+        state.source = 'fetch'
+        state.updated_at = now
+    # Отправления, которых больше нет в выгрузке, ушли из awaiting_deliver (пропущенные push-события)
+    departed = []
+    for posting_number, state in existing.items():
+        if posting_number not in fetched and state.status == 'awaiting_deliver':
+            state.status = 'not_awaiting'
+            state.source = 'fetch'
+            state.updated_at = now
+            departed.append(posting_number)
+    shop.orders_synced_at = now
+    shop.orders_warmed_until = warmed_until
+    db.session.commit()
+    archive_status_events(shop.id, {**{posting_number: 'awaiting_deliver' for posting_number in returned},
+                                    **{posting_number: 'not_awaiting' for posting_number in departed}})
+    schedule_departed_postings_resolution(shop, departed)
+    print(f"OZON_SYNC: Shop {shop.shop_name} reconciled: {len(fetched)} awaiting posting(s), {len(departed)} moved out since last sync.")
+
+def purge_stale_posting_states():
+    """Удаляет давно ушедшие из awaiting_deliver отправления (и записи 'new' без данных), уже попавшие в архив.
+    Без чистки таблица и индекс поиска растут без ограничений."""
+    cutoff = datetime.utcnow() - timedelta(days=POSTING_STATE_RETENTION_DAYS)
+    deleted = OzonPostingState.query.filter(
+        OzonPostingState.status != 'awaiting_deliver',
+        OzonPostingState.updated_at < cutoff,
+        db.or_(OzonPostingState.archived_at.isnot(None), OzonPostingState.data.is_(None))
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    if deleted:
+        print(f"OZON_SYNC: Purged {deleted} posting state(s) not awaiting delivery for over {POSTING_STATE_RETENTION_DAYS} days.")
+    return deleted
+
+# --- Архив отправлений: колоночные файлы по магазину и дню для отчетов за длинные периоды ---
+# Каждое отправление пишется один раз (отметка OzonPostingState.archived_at), файлы только добавляются:
+# <POSTINGS_ARCHIVE_DIR>/shop=<id>/day=<YYYY-MM-DD>/part-<время>-<uuid>.parquet
+# Смены статуса после awaiting_deliver (отгрузка, отмена) дописываются событиями по дню события:
+# <POSTINGS_ARCHIVE_DIR>/shop=<id>/events/day=<YYYY-MM-DD>/part-*.parquet; отчет берет последнее событие отправления
+
+ARCHIVE_COLUMNS = ['shop_id', 'posting_number', 'line_no', 'order_day', 'track_number', 'warehouse',
+                   'offer_id', 'name', 'quantity', 'archived_at']
+ARCHIVE_ROW_KEY = ['shop_id', 'posting_number', 'line_no']
+ARCHIVE_EVENT_COLUMNS = ['shop_id', 'posting_number', 'status', 'event_at']
+
+def archive_shop_dir(shop_id):
+    return os.path.join(POSTINGS_ARCHIVE_DIR, f"shop={shop_id}")
+
+def archive_events_dir(shop_id):
+    return os.path.join(archive_shop_dir(shop_id), 'events')
+
+def archive_partition_dir(shop_id, day):
+    return os.path.join(archive_shop_dir(shop_id), f"day={day:%Y-%m-%d}")
+
+def posting_archive_rows(shop_id, posting, archived_at):
+    """Строки архива для отправления: по одной на товар."""
+    try:
+        order_day = datetime.strptime(posting.get("order_date", ""), "%d.%m.%Y")
+    except ValueError:
+        order_day = archived_at.replace(hour=0, minute=0, second=0, microsecond=0) # дата Ozon не разобралась
+    products = posting.get("products") or [{}] # отправление без товаров тоже считается в отчетах
+    return [
+        {
+            "shop_id": shop_id,
+            "posting_number": posting.get("posting_number", ""),
+            "line_no": line_no,
+            "order_day": order_day,
+            "track_number": posting.get("track_number", ""),
+            "warehouse": posting.get("warehouse", ""),
+            "offer_id": product.get("offer_id", ""),
+            "name": product.get("name", ""),
+            "quantity": int(product.get("quantity") or 0),
+            "archived_at": archived_at
+        }
+        for line_no, product in enumerate(products)
+    ]
+
+def write_archive_frame(path, frame):
+    tmp_path = path + '.part'
+    frame.to_parquet(tmp_path, index=False, compression=POSTINGS_ARCHIVE_COMPRESSION)
+    os.replace(tmp_path, path) # отчеты не видят недописанный файл
+
+def write_archive_partitions(shop_id, rows):
+    """Дописывает строки новыми part-файлами в разделы по дням. Возвращает число файлов."""
+    frame = pd.DataFrame(rows, columns=ARCHIVE_COLUMNS).astype({'shop_id': 'int32', 'line_no': 'int16', 'quantity': 'int32'})
+    file_stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    written = 0
+    for order_day, day_frame in frame.groupby('order_day', sort=False):
+        partition_dir = archive_partition_dir(shop_id, order_day)
+        os.makedirs(partition_dir, exist_ok=True)
+        write_archive_frame(os.path.join(partition_dir, f"part-{file_stamp}-{uuid.uuid4().hex[:8]}.parquet"), day_frame)
+        written += 1
+    return written
+
+def archive_status_events(shop_id, statuses):
+    """Дописывает события {posting_number: статус} одним файлом в раздел текущего дня. Ошибка только логируется."""
+    if not statuses:
+        return
+    try:
+        event_at = datetime.utcnow()
+        frame = pd.DataFrame([{"shop_id": shop_id, "posting_number": posting_number, "status": str(status), "event_at": event_at}
+                              for posting_number, status in statuses.items()], columns=ARCHIVE_EVENT_COLUMNS).astype({'shop_id': 'int32'})
+        partition_dir = os.path.join(archive_events_dir(shop_id), f"day={event_at:%Y-%m-%d}")
+        os.makedirs(partition_dir, exist_ok=True)
+        write_archive_frame(os.path.join(partition_dir, f"part-{event_at:%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.parquet"), frame)
+    except Exception as e:
+        print(f"POSTINGS_ARCHIVE: Shop ID {shop_id}: failed to write {len(statuses)} status event(s): {e}")
+
+def schedule_departed_postings_resolution(shop, posting_numbers):
+    # Сверка знает только, что отправление ушло из awaiting_deliver; отгружено оно или отменено, дочитываем в фоне
+    if posting_numbers:
+        _orders_warmup_executor.submit(resolve_departed_postings, shop.id, posting_numbers[:ARCHIVE_STATUS_RESOLVE_MAX])
+
+def resolve_departed_postings(shop_id, posting_numbers):
+    with app.app_context():
+        try:
+            shop = db.session.get(OzonShop, shop_id)
+            if not shop:
+                return
+            statuses = {}
+            for posting_number in posting_numbers:
+                try:
+                    statuses[posting_number] = fetch_ozon_posting(shop, posting_number).get("status") or 'not_awaiting'
+                except requests.exceptions.RequestException as e:
+                    print(f"POSTINGS_ARCHIVE: Shop {shop.shop_name}: could not read status of {posting_number}: {e}")
+                    break # Ozon недоступен или разомкнут предохранитель — остальные останутся not_awaiting
+            for state in OzonPostingState.query.filter(OzonPostingState.shop_id == shop_id,
+                                                       OzonPostingState.posting_number.in_(list(statuses)),
+                                                       OzonPostingState.status == 'not_awaiting').all():
+                state.status = statuses[state.posting_number][:64]
+            db.session.commit()
+            archive_status_events(shop_id, statuses)
+        except Exception as e:
+            db.session.rollback()
+            print(f"POSTINGS_ARCHIVE: Resolving departed postings for shop ID {shop_id} failed: {e}")
+
+def archive_pending_postings(shop):
+    """Пишет в архив еще не архивированные отправления магазина. Ошибка архива не мешает работе с заказами."""
+    try:
+        pending = OzonPostingState.query.filter(
+            OzonPostingState.shop_id == shop.id,
+            OzonPostingState.archived_at.is_(None),
+            OzonPostingState.data.isnot(None)
+        ).all()
+        if not pending:
+            return 0
+        now = datetime.utcnow()
+        rows = []
+        for state in pending:
+            rows.extend(posting_archive_rows(shop.id, json.loads(state.data), now))
+        files_written = write_archive_partitions(shop.id, rows)
+        # Сбой между записью файлов и коммитом даст повторную запись — дубли отбрасывает load_archive_frame
+        for state in pending:
+            state.archived_at = now
+        db.session.commit()
+        # Отправление могло уйти из awaiting_deliver до архивации (push, запуск archive-ozon-postings)
+        archive_status_events(shop.id, {state.posting_number: state.status for state in pending if state.status != 'awaiting_deliver'})
+        print(f"POSTINGS_ARCHIVE: Shop {shop.shop_name}: archived {len(pending)} posting(s) ({len(rows)} row(s)) into {files_written} file(s).")
+        return len(pending)
+    except Exception as e:
+        db.session.rollback()
+        print(f"POSTINGS_ARCHIVE: Shop {shop.shop_name}: archiving failed: {e}")
+        return 0
+
+def archive_partition_files(shop_ids, date_from, date_to, events=False):
+    # Разделы отбираются по именам каталогов: файлы вне магазинов и периода не открываются
+    day_from, day_to = date_from.isoformat(), date_to.isoformat()
+    paths = []
+    for shop_id in shop_ids:
+        shop_dir = archive_events_dir(shop_id) if events else archive_shop_dir(shop_id)
+        if not os.path.isdir(shop_dir):
+            continue
+        for partition in os.listdir(shop_dir):
+            if not partition.startswith('day=') or not day_from <= partition[len('day='):] <= day_to:
+                continue
+            partition_dir = os.path.join(shop_dir, partition)
+            paths.extend(os.path.join(partition_dir, name) for name in os.listdir(partition_dir) if name.endswith('.parquet'))
+    return paths
+
+def load_archive_frame(shop_ids, date_from, date_to, columns):
+    """Строки архива за период (даты включительно); читаются только нужные колонки."""
+    read_columns = list(dict.fromkeys(ARCHIVE_ROW_KEY + list(columns)))
+    paths = archive_partition_files(shop_ids, date_from, date_to)
+    if not paths:
+        return pd.DataFrame(columns=read_columns)
+    frame = pd.concat((pd.read_parquet(path, columns=read_columns) for path in paths), ignore_index=True)
+    return frame.drop_duplicates(subset=ARCHIVE_ROW_KEY, ignore_index=True)
+
+def load_latest_statuses(shop_ids, date_from):
+    """Последний известный статус отправлений после awaiting_deliver. Отправление периода могло сменить статус
+    позже, поэтому читаются события с начала периода по сегодня."""
+    paths = archive_partition_files(shop_ids, date_from, datetime.utcnow().date(), events=True)
+    if not paths:
+        return pd.DataFrame({'shop_id': pd.Series(dtype='int32'), 'posting_number': pd.Series(dtype=object),
+                             'status': pd.Series(dtype=object)})
+    events = pd.concat((pd.read_parquet(path) for path in paths), ignore_index=True)
+    latest = events.sort_values('event_at', kind='stable').drop_duplicates(subset=['shop_id', 'posting_number'], keep='last')
+    return latest[['shop_id', 'posting_number', 'status']]
+
+def build_postings_report(shops, date_from, date_to, group_by):
+    """Агрегат по архиву: число отправлений и товаров в разрезе полей group_by (ключи REPORT_GROUP_FIELDS).
+    Отмененные отправления не входят в postings/items и считаются отдельно в cancelled."""
+    shop_names = {shop.id: shop.shop_name for shop in shops}
+    columns = ['order_day', 'quantity'] + [field for field in ('warehouse', 'offer_id') if field in group_by]
+    if 'offer_id' in group_by:
+        columns.append('name')
+    frame = load_archive_frame(list(shop_names), date_from, date_to, columns)
+    result_columns = group_by + (['name'] if 'offer_id' in group_by else []) + ['postings', 'items', 'cancelled']
+    if frame.empty:
+        return pd.DataFrame(columns=result_columns)
+    frame = frame.merge(load_latest_statuses(list(shop_names), date_from), on=['shop_id', 'posting_number'], how='left')
+    cancelled = frame['status'].str.contains('cancel', case=False, na=False)
+    frame['posting_key'] = frame['shop_id'].astype(str) + ':' + frame['posting_number']
+    frame['shipped_key'] = frame['posting_key'].where(~cancelled)
+    frame['cancelled_key'] = frame['posting_key'].where(cancelled)
+    frame['shipped_quantity'] = frame['quantity'].where(~cancelled, 0)
+    if 'shop' in group_by:
+        frame['shop'] = frame['shop_id'].map(shop_names)
+    if 'day' in group_by:
+        frame['day'] = frame['order_day'].dt.strftime('%Y-%m-%d')
+    if 'month' in group_by:
+        frame['month'] = frame['order_day'].dt.strftime('%Y-%m')
+    if not group_by:
+        return pd.DataFrame([{"postings": frame['shipped_key'].nunique(), "items": int(frame['shipped_quantity'].sum()),
+                              "cancelled": frame['cancelled_key'].nunique()}])
+    aggregations = {"postings": ('shipped_key', 'nunique'), "items": ('shipped_quantity', 'sum'),
+                    "cancelled": ('cancelled_key', 'nunique')}
+    if 'offer_id' in group_by:
+        aggregations["name"] = ('name', 'first')
+    report = frame.groupby(group_by, sort=True).agg(**aggregations).reset_index()[result_columns]
+    if 'day' not in group_by and 'month' not in group_by:
+        report = report.sort_values('items', ascending=False, kind='stable')
+    return report
+
+def compact_archive_partition(partition_dir, row_key=ARCHIVE_ROW_KEY):
+    """Сливает part-файлы раздела в один. Файлы, дописанные во время слияния, не трогаются. Возвращает число слитых."""
+    part_paths = sorted(os.path.join(partition_dir, name) for name in os.listdir(partition_dir) if name.endswith('.parquet'))
+    if len(part_paths) < 2:
+        return 0
+    frame = pd.concat((pd.read_parquet(path) for path in part_paths), ignore_index=True)
+    frame = frame.drop_duplicates(subset=row_key, ignore_index=True)
+    file_stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    write_archive_frame(os.path.join(partition_dir, f"part-{file_stamp}-{uuid.uuid4().hex[:8]}.parquet"), frame)
+    for path in part_paths:
+        os.remove(path)
+    return len(part_paths)
+
+# --- Прогрев заказов: при входе пользователя и по расписанию перед сменой ---
+
+_orders_warmup_executor = ThreadPoolExecutor(max_workers=ORDERS_WARMUP_MAX_WORKERS, thread_name_prefix='orders-warmup')
+_orders_warmup_inflight = {} # ключ учетных данных магазина -> Future
+_orders_warmup_lock = threading.Lock()
+
+def shop_credentials_key(shop):
+    # Магазины разных пользователей с одними учетными данными и складом получают одну и ту же выгрузку
+    api_key_hash = hashlib.sha256(shop.api_key.encode('utf-8')).hexdigest()[:16]
+    return (shop.client_id, api_key_hash, shop.warehouse_name or "rFBS")
+
+def schedule_orders_warmup(shops, fresh_seconds=None):
+    """Ставит фоновую выгрузку заказов для магазинов с устаревшим состоянием. Возвращает запущенные Future."""
+    fresh_seconds = ORDERS_WARMUP_TTL_SECONDS if fresh_seconds is None else fresh_seconds
+    started = []
+    for shop in shops:
+        if shop_orders_cache_is_fresh(shop):
+            continue
+        key = shop_credentials_key(shop)
+        with _orders_warmup_lock:
+            future = _orders_warmup_inflight.get(key)
+            if future and not future.done():
+                continue # Те же учетные данные уже выгружаются
+            future = _orders_warmup_executor.submit(run_orders_warmup, shop.id, fresh_seconds)
+            _orders_warmup_inflight[key] = future
+        started.append(future)
+    return started
+
+def run_orders_warmup(shop_id, fresh_seconds):
+    # Выполняется в фоновом потоке: одна выгрузка из Ozon сохраняется во все магазины с теми же учетными данными
+    with app.app_context():
+        try:
+            shop = db.session.get(OzonShop, shop_id)
+            if not shop:
+                return
+            key = shop_credentials_key(shop)
+            siblings = [s for s in OzonShop.query.filter_by(client_id=shop.client_id, api_key=shop.api_key).all()
+                        if shop_credentials_key(s) == key]
+            fetched = fetch_ozon_awaiting_postings(shop)
+            warmed_until = datetime.utcnow() + timedelta(seconds=fresh_seconds)
+            for sibling in siblings:
+                grouped_postings, _ = sync_shop_postings(sibling, fetched=fetched, warmed_until=warmed_until)
+                if sibling.label_prefetch_account and grouped_postings:
+                    requested_tracks = get_requested_track_numbers((p["track_number"] for p in grouped_postings), sibling.user_id)
+                    schedule_label_prefetch(sibling.label_prefetch_account,
+                                            [p["track_number"] for p in grouped_postings if p["track_number"] not in requested_tracks])
+            print(f"ORDERS_WARMUP: Shop {shop.shop_name} warmed ({len(fetched[0])} posting(s)), shared with {len(siblings) - 1} other shop(s).")
+        except Exception as e:
+            db.session.rollback()
+            print(f"ORDERS_WARMUP: Warm-up for shop ID {shop_id} failed: {e}")
+
+def wait_for_orders_warmup(shop):
+    """Если прогрев магазина уже идет в этом процессе, ждем его вместо второй выгрузки. True — прогрев был."""
+    key = shop_credentials_key(shop)
+    with _orders_warmup_lock:
+        future = _orders_warmup_inflight.get(key)
+        if future and future.done():
+            _orders_warmup_inflight.pop(key) # результат уже в базе, дальше сессию обновлять не нужно
+    if not future:
+        return False
+    try:
+        future.result(timeout=ORDERS_WARMUP_WAIT_SECONDS)
+    except Exception as e:
+        print(f"ORDERS_WARMUP: Not waiting for warm-up of shop {shop.shop_name}: {e!r}")
+    return True
+
+def orders_warmup_shops_for_login(user):
+    if ORDERS_WARMUP_ON_LOGIN == 'all':
+        return OzonShop.query.filter_by(user_id=user.id).all()
+    if ORDERS_WARMUP_ON_LOGIN == 'default':
+        shop = OzonShop.query.filter_by(user_id=user.id, is_default=True).first() or OzonShop.query.filter_by(user_id=user.id).first()
+        return [shop] if shop else []
+    return []
+
+def fetch_ozon_posting(shop, posting_number):
+    payload = {"posting_number": posting_number, "with": {"analytics_data": False, "barcodes": False, "financial_data": False}}
+    response_obj = call_upstream('ozon:fbs_get', ozon_circuit_key(shop), requests.post, OZON_FBS_GET_URL, headers=ozon_headers(shop), json=payload, timeout=10)
+    response_obj.raise_for_status()
+    return response_obj.json().get("result", {})
+
+def apply_ozon_push_notification(shop, message):
+    """Обновляет сохраненное состояние отправления по push-уведомлению. Возвращает описание действия."""
+    message_type = message.get("message_type")
+    posting_number = message.get("posting_number")
+    new_state = message.get("new_state")
+    if isinstance(new_state, dict): # В TYPE_POSTING_CANCELLED new_state — объект {id, name}
+        new_state = new_state.get("name") or new_state.get("id")
+    state = OzonPostingState.query.filter_by(shop_id=shop.id, posting_number=posting_number).first()
+    now = datetime.utcnow()
+
+    if message_type == "TYPE_NEW_POSTING":
+        # Новое отправление еще не собрано (awaiting_packaging) — в таблицу оно попадет при переходе в awaiting_deliver
+        if state is None:
+            state = OzonPostingState(shop_id=shop.id, posting_number=posting_number, status='new')
+            db.session.add(state)
+        action = f"new posting {posting_number} registered"
+    elif message_type == "TYPE_STATE_CHANGED" and new_state == "posting_awaiting_deliver":
+        # В уведомлении нет трек-номера и названий товаров — дочитываем одно отправление вместо полной выгрузки
+        posting = fetch_ozon_posting(shop, posting_number)
+        grouped_posting = build_grouped_posting(posting, shop.warehouse_name if shop.warehouse_name else "rFBS")
+        if state is None:
+            state = OzonPostingState(shop_id=shop.id, posting_number=posting_number)
+            db.session.add(state)
+        if grouped_posting and posting.get("status") == "awaiting_deliver":
+            state.status = 'awaiting_deliver'
+            state.data = json.dumps(grouped_posting, ensure_ascii=False)
+            action = f"posting {posting_number} stored as awaiting_deliver"
+        else:
+            state.status = posting.get("status") or 'not_awaiting'
+            action = f"posting {posting_number} skipped (status {state.status}, other warehouse or no track)"
+    elif message_type in ("TYPE_STATE_CHANGED", "TYPE_POSTING_CANCELLED"):
+        if state is None:
+            return f"posting {posting_number} is unknown, state {new_state} ignored"
+        state.status = str(new_state or 'not_awaiting')[:64]
+        action = f"posting {posting_number} moved to {state.status}"
     else:
-        return {"postings": [], "error": current_error if current_error else "Нет данных для отображения"}, active_shop.shop_name, current_error if current_error else "Нет данных для отображения", 200 if not current_error else 404
+        return f"message type {message_type} ignored"
 
+    state.source = 'push'
+    state.updated_at = now
+    db.session.commit()
+    if state.data and not state.archived_at:
+        archive_pending_postings(shop) # отправление может уйти из awaiting_deliver до следующей полной сверки
+    elif state.archived_at and state.status != 'awaiting_deliver':
+        event_status = 'cancelled' if message_type == "TYPE_POSTING_CANCELLED" else state.status
+        archive_status_events(shop.id, {posting_number: event_status})
+    return action
+
+def group_duplicate_tracks(grouped_postings):
+    """Один проход по отправлениям: трек -> номера отправлений, если трек встречается в таблице больше одного раза
+    (несколько отправлений с одним треком или несколько товаров в одном отправлении)."""
+    rows_per_track = {}
+    postings_per_track = {}
+    for posting in grouped_postings:
+        track = posting["track_number"]
+        rows_per_track[track] = rows_per_track.get(track, 0) + max(len(posting["products"]), 1)
+        postings_per_track.setdefault(track, []).append(posting["posting_number"])
+    return {track: postings_per_track[track] for track, count in rows_per_track.items() if count > 1}
+
+def flatten_postings_to_rows(grouped_postings, shop_name):
+    # Плоские строки "по товару" — формат Excel-выгрузки (таблица на странице рендерится по отправлениям)
+    rows = []
+    for posting in grouped_postings:
+        for product in posting["products"]:
+            rows.append({
+                "Магазин": shop_name,
+                "Дата заказа": posting["order_date"],
+                "Номер отправления": posting["posting_number"],
+                "Артикул": product["offer_id"],
+                "Наименование товара": product["name"],
+                "Количество": product["quantity"],
+                "Трек-номер": posting["track_number"], 
+                "Склад": posting["warehouse"],
+                "4 Большие цифры": posting["big_digits"]
+            })
+    return rows
+
+
+# --- Поиск отправлений по всем магазинам пользователя ---
+# Индекс строится из сохраненного состояния отправлений (сверка + push), к Ozon поиск не обращается
+
+class PostingSearchIndex:
+    """Префиксный индекс: отсортированный список ключей и бинарный поиск по нему."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        keyed = []
+        for entry_id, entry in enumerate(entries):
+            keyed.append((entry["posting_number"].lower(), 'posting_number', entry_id))
+            if entry.get("track_number"):
+                keyed.append((entry["track_number"].lower(), 'track_number', entry_id))
+            if entry.get("big_digits"):
+                keyed.append((entry["big_digits"].lower(), 'big_digits', entry_id))
+            for offer_id in {p["offer_id"] for p in entry.get("products", []) if p.get("offer_id")}:
+                keyed.append((offer_id.lower(), 'offer_id', entry_id))
+        keyed.sort()
+        self.keys = [key for key, _, _ in keyed]
+        self.refs = [(field, entry_id) for _, field, entry_id in keyed]
+
+    def search(self, query, limit=SEARCH_MAX_RESULTS):
+        """Возвращает [(entry, совпавшие поля)] в порядке ключей, не больше limit отправлений."""
+        prefix = query.strip().lower()
+        matches = OrderedDict()
+        for i in range(bisect.bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[i].startswith(prefix):
+                break
+            field, entry_id = self.refs[i]
+            if entry_id not in matches and len(matches) >= limit:
+                break
+            matches.setdefault(entry_id, []).append(field)
+        return [(self.entries[entry_id], fields) for entry_id, fields in matches.items()]
+
+_search_indexes = OrderedDict() # user_id -> (версия, PostingSearchIndex), LRU
+_search_indexes_lock = threading.Lock()
+
+def posting_search_version(shops):
+    # Любое изменение состояния (сверка, push) сдвигает updated_at или число записей — индекс перестраивается
+    shop_ids = [shop.id for shop in shops]
+    count, last_updated = db.session.query(db.func.count(OzonPostingState.id), db.func.max(OzonPostingState.updated_at)) \
+        .filter(OzonPostingState.shop_id.in_(shop_ids)).one()
+    return (tuple((shop.id, shop.shop_name) for shop in shops), count, last_updated)
+
+def build_posting_search_index(shops):
+    shop_names = {shop.id: shop.shop_name for shop in shops}
+    entries = []
+    states = OzonPostingState.query.filter(OzonPostingState.shop_id.in_(list(shop_names)), OzonPostingState.data.isnot(None)).all()
+    for state in states:
+        posting = json.loads(state.data)
+        posting.update({"shop_id": state.shop_id, "shop_name": shop_names[state.shop_id], "status": state.status})
+        entries.append(posting)
+    return PostingSearchIndex(entries)
+
+def get_posting_search_index(user_id):
+    shops = OzonShop.query.filter_by(user_id=user_id).order_by(OzonShop.id).all()
+    if not shops:
+        return None, []
+    version = posting_search_version(shops)
+    with _search_indexes_lock:
+        cached = _search_indexes.get(user_id)
+        if cached and cached[0] == version:
+            _search_indexes.move_to_end(user_id)
+            return cached[1], shops
+    index = build_posting_search_index(shops)
+    with _search_indexes_lock:
+        _search_indexes[user_id] = (version, index)
+        _search_indexes.move_to_end(user_id)
+        while len(_search_indexes) > SEARCH_INDEX_CACHE_SIZE:
+            _search_indexes.popitem(last=False)
+    print(f"SEARCH: Built index for user ID {user_id}: {len(index.entries)} posting(s), {len(index.keys)} key(s).")
+    return index, shops
+
+# --- Версии наборов заказов, условные ответы и сжатие ---
+
+_orders_table_cache = OrderedDict() # версия набора заказов -> отрендеренная таблица (LRU)
+_orders_table_cache_lock = threading.Lock()
+
+def compute_build_version():
+    # После деплоя с новыми шаблонами/скриптами старые ETag не должны давать 304; одинаково во всех воркерах
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    mtimes = [os.path.getmtime(os.path.join(base_dir, 'app.py'))]
+    for folder in ('templates', 'static'):
+        folder_path = os.path.join(base_dir, folder)
+        mtimes.extend(os.path.getmtime(os.path.join(folder_path, name)) for name in os.listdir(folder_path))
+    return str(int(max(mtimes)))
+
+BUILD_VERSION = compute_build_version()
+
+def compute_orders_version(data_dict, shop_name):
+    """Версия набора заказов: хеш от содержимого, меняется только при изменении данных Ozon или отметок."""
+    payload = json.dumps(
+        {"build": BUILD_VERSION, "shop": shop_name, "postings": data_dict.get("grouped_postings", []), "error": data_dict.get("error")},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def not_modified_response(etag):
+    # 304 без тела, если клиент уже имеет эту версию
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def render_orders_table(postings, version):
+    with _orders_table_cache_lock:
+        cached = _orders_table_cache.get(version)
+        if cached is not None:
+            _orders_table_cache.move_to_end(version)
+            return cached
+    rendered = render_template('ozon_orders_table.html', postings=postings)
+    with _orders_table_cache_lock:
+        _orders_table_cache[version] = rendered
+        if len(_orders_table_cache) > ORDERS_TABLE_CACHE_SIZE:
+            _orders_table_cache.popitem(last=False)
+    return rendered
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in GZIP_MIMETYPES
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE_BYTES:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=GZIP_COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+# --- Контроль допуска: тяжелые маршруты не занимают все потоки воркера ---
+# Слоты считаются в процессе, как и предохранители: у каждого воркера gunicorn свои
+
+class AdmissionGate:
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.total_admitted = 0
+        self.total_rejected = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        # Не ждем освобождения слота: лишний запрос сразу получает отказ, а не висит в очереди воркера
+        with self._lock:
+            if self.in_use >= self.limit:
+                self.total_rejected += 1
+                return False
+            self.in_use += 1
+            self.total_admitted += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+
+_admission_gates = {name: AdmissionGate(name, limit) for name, limit in ADMISSION_LIMITS.items()}
+
+def admission_rejected_response(gate):
+    retry_after = ADMISSION_RETRY_AFTER_SECONDS.get(gate.name, 5)
+    message = "Сервер сейчас обрабатывает много тяжелых запросов. Повторите через несколько секунд."
+    if request.endpoint == 'ozon_push':
+        response = jsonify({"error": {"code": "ERROR_UNKNOWN", "message": message, "details": None}}) # формат ошибок push Ozon
+    elif request.path.startswith('/api/') or request.is_json or request.accept_mimetypes.best == 'application/json':
+        response = jsonify({"success": False, "error": message, "retry_after": retry_after})
+    else:
+        response = Response(render_template('busy.html', title="Сервер занят", message=message, retry_after=retry_after))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.before_request
+def admit_request():
+    gate = _admission_gates.get(ADMISSION_ROUTE_CLASSES.get(request.endpoint))
+    if gate is None or gate.limit <= 0:
+        return
+    if gate.try_acquire():
+        g.admission_gate = gate
+        return
+    if request.endpoint == 'get_cdek_labels_route':
+        # Запрос этикеток не отклоняем: задача ставится в очередь планировщика, маршрут сразу отдает 202
+        g.admission_degraded = True
+        return
+    print(f"ADMISSION: Rejected {request.method} {request.path}: '{gate.name}' slots full ({gate.in_use}/{gate.limit}).")
+    return admission_rejected_response(gate)
+
+@app.teardown_request
+def release_admission_slot(exc):
+    gate = g.pop('admission_gate', None)
+    if gate:
+        gate.release()
+
+# --- Профилирование запросов ---
+
+def user_is_admin(user):
+    return bool(user and user.is_authenticated and user.email.lower() in ADMIN_EMAILS)
+
+@app.context_processor
+def inject_admin_flag():
+    return {"current_user_is_admin": user_is_admin(current_user)}
+
+def should_profile_request():
+    if request.endpoint in (None, 'static'):
+        return False
+    if user_is_admin(current_user) and (request.args.get('profile') == '1' or session.get('profile_requests')):
+        return True
+    return request.endpoint in PROFILE_SAMPLED_ENDPOINTS and PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+_profiling_lock = threading.Lock() # tracemalloc общий на процесс: профилируем один запрос за раз
+
+@app.before_request
+def start_request_profiling():
+    if not should_profile_request():
+        return
+    if not _profiling_lock.acquire(blocking=False):
+        print(f"PROFILE: Skipping {request.path}: another request is being profiled in this process.")
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e: # Уже работает другой профайлер в этом потоке
+        _profiling_lock.release()
+        print(f"PROFILE: Could not start profiler for {request.path}: {e}")
+        return
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    g.profile_state = {
+        "profiler": profiler,
+        "started_tracemalloc": started_tracemalloc,
+        "started_at": time.perf_counter(),
+        "status_code": None
+    }
+
+@app.after_request
+def remember_profiled_status(response):
+    if getattr(g, 'profile_state', None):
+        g.profile_state["status_code"] = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_profiling(exc):
+    # teardown вызывается и при необработанном исключении — упавшие запросы тоже попадают в отчет
+    state = g.pop('profile_state', None)
+    if not state:
+        return
+    profiler = state["profiler"]
+    profiler.disable()
+    duration = time.perf_counter() - state["started_at"]
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    top_allocations = tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]
+    if state["started_tracemalloc"]:
+        tracemalloc.stop()
+    _profiling_lock.release()
+    try:
+        save_profile_report(profiler, duration, peak_bytes, top_allocations, state["status_code"], exc)
+    except Exception as e:
+        print(f"PROFILE: Failed to save report for {request.path}: {e}")
+
+def save_profile_report(profiler, duration, peak_bytes, top_allocations, status_code, exc):
+    os.makedirs(PROFILE_REPORTS_DIR, exist_ok=True)
+    user_part = str(current_user.id) if current_user.is_authenticated else "anon"
+    report_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{request.endpoint}_user{user_part}"
+
+    stats_stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stats_stream)
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    stats.dump_stats(os.path.join(PROFILE_REPORTS_DIR, f"{report_name}.prof"))
+
+    lines = [
+        f"Endpoint: {request.endpoint}",
+        f"Request: {request.method} {request.full_path}",
+        f"User: {current_user.email if current_user.is_authenticated else 'anonymous'}",
+        f"Status: {status_code if status_code is not None else 'exception'}",
+        f"Exception: {exc!r}" if exc else "Exception: none",
+        f"Duration: {duration:.3f} s",
+        f"Peak traced memory: {peak_bytes / (1024 * 1024):.2f} MiB",
+        "",
+        f"Top {PROFILE_TOP_ALLOCATIONS} allocations by line (live at end of request):"
+    ]
+    lines.extend(f"  {stat}" for stat in top_allocations)
+    lines.extend(["", stats_stream.getvalue()])
+    with open(os.path.join(PROFILE_REPORTS_DIR, f"{report_name}.txt"), 'w', encoding='utf-8') as report_file:
+        report_file.write("\n".join(lines))
+    print(f"PROFILE: Saved report {report_name} ({request.endpoint}, {duration:.2f}s, peak {peak_bytes / (1024 * 1024):.1f} MiB)")
+
+    # Храним только последние отчеты
+    report_files = sorted(name for name in os.listdir(PROFILE_REPORTS_DIR) if name.endswith('.txt'))
+    for old_name in report_files[:-PROFILE_MAX_REPORTS]:
+        for suffix in ('.txt', '.prof'):
+            old_path = os.path.join(PROFILE_REPORTS_DIR, old_name[:-len('.txt')] + suffix)
+            if os.path.exists(old_path):
+                os.remove(old_path)
 
 # --- Маршруты ---
 @app.route('/')
@@ -387,7 +2081,7 @@ def get_ozon_awaiting_deliver_orders(): # Теперь использует ак
 def index():
     # active_shop = get_active_ozon_shop() # Это уже проверяется в get_ozon_awaiting_deliver_orders
     
-    data_dict, shop_name_used, error_from_func, status_code = get_ozon_awaiting_deliver_orders()
+    data_dict, shop_name_used, error_from_func, status_code = get_ozon_awaiting_deliver_orders(force_refresh=request.args.get('refresh') == '1')
 
     template_error_message = None # Инициализация переменной для сообщения в шаблоне
 
@@ -403,12 +2097,79 @@ def index():
         # Даже при успехе, функция могла вернуть некритическую ошибку (например, если не найдено заказов)
         template_error_message = data_dict.get("error")
 
-    return render_template(
+    postings = data_dict.get("grouped_postings", []) # Одна строка таблицы на отправление, товары вложены в нее
+    open_circuits = get_open_circuits(get_user_circuit_keys())
+    etag = None
+    # Условный ответ только для страницы без flash-сообщений и предупреждений о недоступных сервисах:
+    # они не входят в версию набора заказов
+    if status_code == 200 and not session.get('_flashes') and not open_circuits:
+        version = compute_orders_version(data_dict, shop_name_used)
+        etag = f"orders-{current_user.id}-{version}"
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+        orders_table_html = render_orders_table(postings, version) if postings else ""
+    else:
+        orders_table_html = render_template('ozon_orders_table.html', postings=postings) if postings else ""
+
+    response = app.make_response(render_template(
         'ozon_orders.html',
-        orders=data_dict.get("postings", []), # Безопасное получение списка заказов
+        orders=postings,
+        orders_table_html=orders_table_html,
         ozon_account_name=shop_name_used if shop_name_used else current_user.email,
-        error_message=template_error_message # Сообщение для отображения в области контента
-    )
+        error_message=template_error_message, # Сообщение для отображения в области контента
+        open_circuits=open_circuits
+    ))
+    return with_etag(response, etag) if etag else response
+
+@app.route('/api/ozon_orders')
+@login_required
+def ozon_orders_json():
+    # Компактный формат: товары вложены в отправления, дубликаты треков уже сгруппированы
+    data_dict, shop_name_used, error_from_func, status_code = get_ozon_awaiting_deliver_orders()
+    etag = f"orders-json-{current_user.id}-{compute_orders_version(data_dict, shop_name_used)}"
+    if status_code == 200:
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+    response = jsonify({
+        "shop": shop_name_used,
+        "postings": data_dict.get("grouped_postings", []),
+        "duplicate_tracks": data_dict.get("duplicate_tracks", {}),
+        "error": data_dict.get("error")
+    })
+    response.status_code = status_code
+    return with_etag(response, etag) if status_code == 200 else response
+
+@app.route('/api/search')
+@login_required
+def search_postings():
+    started = time.perf_counter()
+    query = request.args.get('q', '').strip()
+    if len(query) < SEARCH_MIN_QUERY_LENGTH:
+        return jsonify({"query": query, "results": [], "message": f"Введите не меньше {SEARCH_MIN_QUERY_LENGTH} символов."})
+    index, shops = get_posting_search_index(current_user.id)
+    matches = index.search(query) if index else []
+    requested_tracks = get_requested_track_numbers((entry.get("track_number") for entry, _ in matches), current_user.id)
+    results = [{
+        "shop_name": entry["shop_name"],
+        "posting_number": entry["posting_number"],
+        "track_number": entry.get("track_number", ""),
+        "big_digits": entry.get("big_digits", ""),
+        "order_date": entry.get("order_date", ""),
+        "status": entry["status"],
+        "offer_ids": list(dict.fromkeys(p["offer_id"] for p in entry.get("products", []) if p.get("offer_id"))),
+        "matched": fields,
+        "label_requested": entry.get("track_number") in requested_tracks,
+        "can_request_label": entry["status"] == 'awaiting_deliver' and bool(entry.get("track_number")),
+    } for entry, fields in matches]
+    return jsonify({
+        "query": query,
+        "results": results,
+        "truncated": len(results) >= SEARCH_MAX_RESULTS,
+        "unsynced_shops": [shop.shop_name for shop in shops if not shop.orders_synced_at],
+        "took_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
 
 @app.route('/get_cdek_labels', methods=['POST'])
 @login_required
@@ -422,51 +2183,131 @@ def get_cdek_labels_route():
     if not ozon_tracking_numbers:
         return jsonify({"error": "Не выбраны трек-номера Ozon."}), 400
     
-    ozon_tracking_numbers = [tn for tn in ozon_tracking_numbers if tn and tn.strip()]
+    received_count = len(ozon_tracking_numbers)
+    ozon_tracking_numbers, skipped_tracks = normalize_label_tracks(ozon_tracking_numbers, active_cdek_account,
+                                                                   retry_rejected=bool(data.get('retry_rejected')))
     if not ozon_tracking_numbers:
-        return jsonify({"error": "Список выбранных трек-номеров пуст или содержит только пустые значения."}), 400
+        message = "Нет трек-номеров для запроса: все выбранные пропущены." if skipped_tracks else "Список выбранных трек-номеров пуст или содержит только пустые значения."
+        return jsonify({"error": message, "skipped": skipped_tracks}), 400
+
+    print(f"CDEK_ROUTE (User: {current_user.email}, Account: {active_cdek_account.account_name}): Received request for {received_count} Ozon tracking numbers for printing, {len(ozon_tracking_numbers)} after normalization ({len(skipped_tracks)} skipped). Max batch size: {MAX_CDEK_ORDERS_PER_BATCH}.")
+
+    processed_pdf_data = [] 
+    errors = []
 
-    print(f"CDEK_ROUTE (User: {current_user.email}, Account: {active_cdek_account.account_name}): Received request for {len(ozon_tracking_numbers)} Ozon tracking numbers for printing. Max batch size: {MAX_CDEK_ORDERS_PER_BATCH}.")
+    # Этикетки, заранее полученные фоновой предзагрузкой, отдаем сразу без обращения к СДЭК
+    prefetched_labels = take_prefetched_labels(active_cdek_account, ozon_tracking_numbers)
+    prefetched_tracks = [tn for tracks in prefetched_labels for tn in tracks]
+    for tracks, pdf_content in prefetched_labels.items():
+        if len(tracks) == 1:
+            filename = f"cdek_label_{tracks[0].replace('/', '-')}.pdf"
+        else:
+            filename = f"cdek_labels_prefetched_{tracks[0].replace('/', '-')}_{len(tracks)}orders.pdf"
+        processed_pdf_data.append({
+            "content": pdf_content,
+            "filename": filename,
+            "original_tracks_in_chunk": list(tracks)
+        })
+    if prefetched_labels:
+        print(f"CDEK_ROUTE: Served {len(prefetched_tracks)} label(s) in {len(prefetched_labels)} PDF(s) from prefetched store.")
+        served = set(prefetched_tracks)
+        ozon_tracking_numbers = [tn for tn in ozon_tracking_numbers if tn not in served]
     
     chunks = [
         ozon_tracking_numbers[i:i + MAX_CDEK_ORDERS_PER_BATCH] 
         for i in range(0, len(ozon_tracking_numbers), MAX_CDEK_ORDERS_PER_BATCH)
     ]
-    print(f"CDEK_ROUTE: Processing {len(chunks)} chunk(s).")
-
-    processed_pdf_data = [] 
-    errors = []
 
-    for i, chunk in enumerate(chunks):
-        print(f"CDEK_ROUTE: Processing chunk {i + 1}/{len(chunks)} with {len(chunk)} orders.")
-        pdf_content, error_label = process_cdek_label_request_for_chunk(chunk)
-        
-        if error_label:
-            chunk_descriptor_err = chunk[0] if len(chunk) == 1 else f"chunk starting with {chunk[0]} ({len(chunk)} orders)"
-            errors.append({"ozon_track_chunk": chunk_descriptor_err, "error": f"Ошибка получения этикеток для пачки: {error_label}"})
-        
-        if pdf_content:
-            if len(chunk) == 1:
-                filename_hint = f"cdek_label_{chunk[0].replace('/', '-')}.pdf"
-            else:
-                timestamp_part = datetime.now().strftime('%H%M%S%f')[:-3] 
-                filename_hint = f"cdek_labels_batch_{i+1}_{len(chunk)}orders_{timestamp_part}.pdf"
-            
-            processed_pdf_data.append({
-                "content": pdf_content,
-                "filename": filename_hint,
-                "original_tracks_in_chunk": chunk 
-            })
-        elif not error_label: 
-             chunk_descriptor_err = chunk[0] if len(chunk) == 1 else f"chunk starting with {chunk[0]} ({len(chunk)} orders)"
-             errors.append({"ozon_track_chunk": chunk_descriptor_err, "error": "Не удалось получить PDF для пачки по неизвестной причине."})
+    # Если СДЭК для этого аккаунта признан недоступным, не ставим пачки в очередь на заведомые таймауты
+    failed_chunks = []
+    blocking_circuit = get_blocking_circuit([cdek_circuit_key(active_cdek_account)])
+    if blocking_circuit and chunks:
+        circuit_message = circuit_block_message(blocking_circuit)
+        print(f"CDEK_ROUTE: Skipping {len(chunks)} chunk(s), circuit open: {circuit_message}")
+        for chunk in chunks:
+            errors.append({"ozon_track_chunk": describe_label_chunk(chunk), "error": circuit_message})
+            failed_chunks.append((chunk, circuit_message))
+        chunks = []
+        if not processed_pdf_data:
+            response = jsonify({"success": False, "errors": errors, "message": circuit_message, "error": circuit_message, "skipped": skipped_tracks})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(max(1, blocking_circuit.seconds_until_probe()))
+            return response
+
+    if not chunks:
+        # Все доступное уже готово — отдаем сразу, очередь не нужна
+        requested_tracks = [tn for pdf_item in processed_pdf_data for tn in pdf_item["original_tracks_in_chunk"]]
+        record_label_requests(requested_tracks, active_cdek_account, current_user.id)
+        return build_labels_response(processed_pdf_data, errors, skipped_tracks)
+
+    # Если слоты этикеток в процессе заняты, не ждем готовности — сразу отдаем ссылку на задачу
+    deadline = time.monotonic() if g.get('admission_degraded') else request_deadline(data)
+    job = create_label_job(active_cdek_account, current_user.id, chunks, prefetched_labels, failed_chunks, skipped_tracks)
+    if prefetched_labels:
+        record_label_requests(prefetched_tracks, active_cdek_account, current_user.id)
+    ensure_label_scheduler_started()
+    print(f"CDEK_ROUTE: Queued job {job.id} with {len(chunks)} chunk(s).")
+    if wait_for_label_job(job, deadline):
+        return deliver_label_job(job)
+    if g.get('admission_degraded'):
+        print(f"CDEK_ROUTE: Label slots busy, returning handle for job {job.id} without waiting.")
+        return jsonify(label_job_status_payload(job)), 202
+    # Бюджет запроса исчерпан: отдаем ссылку на задачу, готовые пачки забираются по ready_download_url
+    print(f"CDEK_ROUTE: Deadline reached for job {job.id}, returning handle.")
+    return jsonify(label_job_status_payload(job)), 202
+
+@app.route('/label_jobs/<job_id>')
+@login_required
+def label_job_status(job_id):
+    job = LabelJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    if job.status in ('queued', 'running'):
+        ensure_label_scheduler_started() # после рестарта воркера очередь подхватывается при первом опросе
+    return jsonify(label_job_status_payload(job))
 
+@app.route('/label_jobs/<job_id>/download')
+@login_required
+def download_label_job(job_id):
+    job = LabelJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return deliver_label_job(job, include_delivered=request.args.get('all') == '1')
+
+def deliver_label_job(job, include_delivered=False):
+    """Отдает готовые пачки, которые еще не выдавались (с include_delivered — все готовые)."""
+    finished = job.status not in ('queued', 'running')
+    chunks_to_send = [c for c in job.chunks if c.status == 'done' and (include_delivered or not c.delivered_at)]
+    status_payload = label_job_status_payload(job)
+    errors = status_payload["errors"] if finished else []
+    if not chunks_to_send and not finished:
+        return jsonify({"success": False, "message": "Этикетки еще готовятся.", **label_job_status_payload(job)}), 409
+    if not chunks_to_send and not errors and any(c.status == 'done' for c in job.chunks):
+        return jsonify({"success": True, "message": "Все готовые этикетки этой задачи уже загружены."})
+    processed_pdf_data = []
+    for chunk in chunks_to_send:
+        track_numbers = json.loads(chunk.track_numbers)
+        if len(track_numbers) == 1:
+            filename_hint = f"cdek_label_{track_numbers[0].replace('/', '-')}.pdf"
+        else:
+            filename_hint = f"cdek_labels_batch_{chunk.chunk_index + 1}_{len(track_numbers)}orders.pdf"
+        processed_pdf_data.append({
+            "content": chunk.pdf_content,
+            "filename": filename_hint,
+            "original_tracks_in_chunk": track_numbers
+        })
+    now = datetime.utcnow()
+    for chunk in chunks_to_send:
+        chunk.delivered_at = chunk.delivered_at or now
+    db.session.commit()
+    return build_labels_response(processed_pdf_data, errors, status_payload["skipped"])
 
+def build_labels_response(processed_pdf_data, errors, skipped_tracks=None):
+    skipped_tracks = skipped_tracks or []
     if not processed_pdf_data and errors: 
-        return jsonify({"success": False, "errors": errors, "message": "Не удалось получить ни одной этикетки для выбранных заказов."}), 400
+        return jsonify({"success": False, "errors": errors, "skipped": skipped_tracks, "message": "Не удалось получить ни одной этикетки для выбранных заказов."}), 400
     
     if not processed_pdf_data and not errors: 
-         return jsonify({"success": False, "message": "Нет данных для этикеток и нет ошибок (неожиданная ситуация)."}), 400
+         return jsonify({"success": False, "skipped": skipped_tracks, "message": "Нет данных для этикеток и нет ошибок (неожиданная ситуация)."}), 400
+
+    # Пропущенные треки у бинарного ответа передаются заголовком (JSON в ASCII)
+    skipped_headers = {'X-Label-Skipped': json.dumps(skipped_tracks)} if skipped_tracks else {}
 
     if len(processed_pdf_data) == 1 and not errors: 
         single_pdf_item = processed_pdf_data[0]
@@ -474,37 +2315,45 @@ def get_cdek_labels_route():
         return Response(
             single_pdf_item['content'],
             mimetype='application/pdf',
-            headers={'Content-Disposition': f'inline;filename="{single_pdf_item["filename"]}"'},
+            headers={'Content-Disposition': f'inline;filename="{single_pdf_item["filename"]}"', **skipped_headers},
             status=200
         )
     
-    if processed_pdf_data:
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED, False) as zip_file: 
-            for pdf_item in processed_pdf_data:
-                zip_file.writestr(pdf_item["filename"], pdf_item["content"])
-        
-        zip_buffer.seek(0)
-        zip_filename = f"cdek_labels_archive_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-        
-        num_files_in_zip = len(zip_file.namelist())
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED, False) as zip_file: 
+        for pdf_item in processed_pdf_data:
+            zip_file.writestr(pdf_item["filename"], pdf_item["content"])
+    
+    zip_buffer.seek(0)
+    zip_filename = f"cdek_labels_archive_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    
+    num_files_in_zip = len(zip_file.namelist())
 
-        if num_files_in_zip == 0 and errors: 
-             return jsonify({"success": False, "errors": errors, "message": "Не удалось добавить файлы в архив, только ошибки."}), 500
-        elif num_files_in_zip == 0 and not errors: 
-             return jsonify({"success": False, "message": "Архив пуст, нет данных для этикеток."}), 500
+    if num_files_in_zip == 0 and errors: 
+         return jsonify({"success": False, "errors": errors, "message": "Не удалось добавить файлы в архив, только ошибки."}), 500
+    elif num_files_in_zip == 0 and not errors: 
+         return jsonify({"success": False, "message": "Архив пуст, нет данных для этикеток."}), 500
 
-        print(f"CDEK_ROUTE: Prepared ZIP file {zip_filename} with {num_files_in_zip} PDF(s). Total errors during processing: {len(errors)}")
-        
-        return Response(
-            zip_buffer.getvalue(),
-            mimetype='application/zip',
-            headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'},
-            status=200
-        )
+    print(f"CDEK_ROUTE: Prepared ZIP file {zip_filename} with {num_files_in_zip} PDF(s). Total errors during processing: {len(errors)}")
+    
+    return Response(
+        zip_buffer.getvalue(),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{zip_filename}"', **skipped_headers},
+        status=200
+    )
 
-    return jsonify({"success": False, "errors": errors, "message": "Неизвестная ошибка при формировании этикеток."}), 500
 
+@app.route('/clear_requested_labels', methods=['POST'])
+@login_required
+def clear_requested_labels():
+    account_ids = [acc.id for acc in CdekAccount.query.filter_by(user_id=current_user.id).all()]
+    deleted = 0
+    if account_ids:
+        deleted = LabelRequest.query.filter(LabelRequest.cdek_account_id.in_(account_ids)).delete(synchronize_session=False)
+        db.session.commit()
+    print(f"LABEL_REQUESTS: User {current_user.email} cleared {deleted} requested label mark(s).")
+    return jsonify({"success": True, "deleted": deleted})
 
 @app.route('/download_ozon_excel')
 @login_required
@@ -518,7 +2367,12 @@ def download_ozon_excel():
         flash("Нет данных для экспорта в Excel.", "info")
         return redirect(url_for('index'))
 
-    df = pd.DataFrame(data_dict["postings"])
+    etag = f"orders-xlsx-{current_user.id}-{compute_orders_version(data_dict, shop_name)}"
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
+
+    df = pd.DataFrame(flatten_postings_to_rows(data_dict.get("grouped_postings", []), shop_name))
     output = io.BytesIO()
     try:
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -533,12 +2387,197 @@ def download_ozon_excel():
     shop_name_part = shop_name.replace(" ", "_")[:20] if shop_name else "shop"
     filename = f"ozon_orders_{shop_name_part}_{timestamp}.xlsx"
     
-    return send_file(
+    response = send_file(
         output,
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
         as_attachment=True, 
         download_name=filename
     )
+    return with_etag(response, etag)
+
+# --- Отчеты по архиву отправлений ---
+def parse_report_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError(f"Неверная дата '{value}', ожидается ГГГГ-ММ-ДД.")
+
+def parse_report_params(args):
+    """(магазины, дата с, дата по, group_by) из параметров запроса; ValueError с сообщением для пользователя."""
+    date_to = parse_report_date(args.get('date_to')) or datetime.utcnow().date()
+    date_from = parse_report_date(args.get('date_from')) or date_to - timedelta(days=REPORT_DEFAULT_DAYS - 1)
+    if date_from > date_to:
+        raise ValueError("Дата начала периода позже даты окончания.")
+    if (date_to - date_from).days >= REPORT_MAX_DAYS:
+        raise ValueError(f"Период отчета не может быть длиннее {REPORT_MAX_DAYS} дней.")
+    group_by = [field for value in args.getlist('group_by') for field in value.split(',') if field] or ['warehouse', 'offer_id']
+    unknown_fields = [field for field in group_by if field not in REPORT_GROUP_FIELDS]
+    if unknown_fields:
+        raise ValueError(f"Неизвестные поля группировки: {', '.join(unknown_fields)}.")
+    shops_query = OzonShop.query.filter_by(user_id=current_user.id)
+    shop_param = args.get('shop', 'all')
+    if shop_param != 'all':
+        if not shop_param.isdigit():
+            raise ValueError("Неверный магазин.")
+        shops_query = shops_query.filter_by(id=int(shop_param))
+    return shops_query.all(), date_from, date_to, list(dict.fromkeys(group_by))
+
+@app.route('/reports/postings')
+@login_required
+def postings_report():
+    report, error = None, None
+    try:
+        shops, date_from, date_to, group_by = parse_report_params(request.args)
+        report = build_postings_report(shops, date_from, date_to, group_by)
+    except ValueError as e:
+        error = str(e)
+        date_to = datetime.utcnow().date()
+        date_from, group_by = date_to - timedelta(days=REPORT_DEFAULT_DAYS - 1), ['warehouse', 'offer_id']
+    return render_template('postings_report.html', title="Отчет по отправлениям",
+                           report=report.to_dict('records') if report is not None else [],
+                           group_by=group_by, group_fields=REPORT_GROUP_FIELDS, error=error,
+                           date_from=date_from, date_to=date_to, selected_shop=request.args.get('shop', 'all'),
+                           shops=OzonShop.query.filter_by(user_id=current_user.id).all())
+
+@app.route('/api/reports/postings')
+@login_required
+def postings_report_json():
+    try:
+        shops, date_from, date_to, group_by = parse_report_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    report = build_postings_report(shops, date_from, date_to, group_by)
+    return jsonify({
+        "date_from": date_from.isoformat(), "date_to": date_to.isoformat(), "group_by": group_by,
+        "rows": json.loads(report.to_json(orient='records', force_ascii=False))
+    })
+
+@app.route('/reports/postings/export')
+@login_required
+def export_postings_report():
+    try:
+        shops, date_from, date_to, group_by = parse_report_params(request.args)
+    except ValueError as e:
+        flash(str(e), "danger")
+        return redirect(url_for('postings_report'))
+    report = build_postings_report(shops, date_from, date_to, group_by)
+    report = report.rename(columns={**REPORT_GROUP_FIELDS, "name": "Название", "postings": "Отправлений", "items": "Товаров",
+                                    "cancelled": "Отменено"})
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        report.to_excel(writer, index=False, sheet_name=f"{date_from:%d.%m.%Y}-{date_to:%d.%m.%Y}")
+    output.seek(0)
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=f"postings_report_{date_from:%Y%m%d}_{date_to:%Y%m%d}.xlsx"
+    )
+
+# --- Push-уведомления Ozon о статусах отправлений ---
+def ozon_push_error(message, code="ERROR_UNKNOWN", status=400):
+    return jsonify({"error": {"code": code, "message": message, "details": None}}), status
+
+@app.route('/ozon/push/<int:shop_id>/<token>', methods=['POST'])
+def ozon_push(shop_id, token):
+    shop = db.session.get(OzonShop, shop_id)
+    if not shop or not shop.push_token or not hmac.compare_digest(shop.push_token.encode(), token.encode()):
+        return ozon_push_error("Unknown shop or invalid push token", status=403)
+
+    message = request.get_json(silent=True)
+    if not isinstance(message, dict) or not message.get("message_type"):
+        return ozon_push_error("message_type is required", code="ERROR_PARAMETER_VALUE_MISSED")
+    if message["message_type"] == "TYPE_PING":
+        return jsonify({"version": BUILD_VERSION, "name": OZON_PUSH_APP_NAME, "time": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")})
+    if "seller_id" in message and str(message["seller_id"]) != str(shop.client_id):
+        return ozon_push_error("seller_id does not match the shop", status=403)
+    if not isinstance(message.get("posting_number"), str) or not message["posting_number"]:
+        return ozon_push_error("posting_number is required", code="ERROR_PARAMETER_VALUE_MISSED")
+
+    try:
+        action = apply_ozon_push_notification(shop, message)
+    except requests.exceptions.RequestException as e:
+        db.session.rollback()
+        print(f"OZON_PUSH: Shop {shop.shop_name}: failed to process {message['message_type']} for {message['posting_number']}: {e}")
+        return ozon_push_error(f"Temporary error: {e}", status=500) # Ozon повторит доставку
+    print(f"OZON_PUSH: Shop {shop.shop_name}: {action}")
+    return jsonify({"result": True})
+
+# --- Метрики для мониторинга (формат Prometheus) ---
+@app.route('/metrics')
+def metrics():
+    # Метрики раскрывают внутренние id магазинов и аккаунтов: скрейперу нужен METRICS_TOKEN, человеку — вход администратора
+    token_ok = bool(METRICS_TOKEN) and hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {METRICS_TOKEN}".encode())
+    if not token_ok and not user_is_admin(current_user):
+        abort(401)
+    state_values = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    lines = [
+        "# HELP circuit_breaker_state Circuit breaker state (0=closed, 1=half_open, 2=open).",
+        "# TYPE circuit_breaker_state gauge"
+    ]
+    breakers = sorted(_circuit_breakers.values(), key=lambda b: (b.upstream, b.account_key))
+    for b in breakers:
+        lines.append(f'circuit_breaker_state{{upstream="{b.upstream}",account="{b.account_key}"}} {state_values[b.state]}')
+    lines += ["# HELP circuit_breaker_failures_total Upstream failures counted by the breaker.",
+              "# TYPE circuit_breaker_failures_total counter"]
+    for b in breakers:
+        lines.append(f'circuit_breaker_failures_total{{upstream="{b.upstream}",account="{b.account_key}"}} {b.total_failures}')
+    lines += ["# HELP circuit_breaker_rejected_total Calls rejected without reaching the upstream.",
+              "# TYPE circuit_breaker_rejected_total counter"]
+    for b in breakers:
+        lines.append(f'circuit_breaker_rejected_total{{upstream="{b.upstream}",account="{b.account_key}"}} {b.total_rejected}')
+    # Значения ниже — по процессу, ответившему на запрос; pid различает воркеры gunicorn
+    pid = os.getpid()
+    gates = sorted(_admission_gates.values(), key=lambda gate: gate.name)
+    for metric, help_text, metric_type, attr in (
+        ("admission_slots_in_use", "Heavy requests currently holding a slot.", "gauge", "in_use"),
+        ("admission_slots_limit", "Concurrent slots allowed for the route class.", "gauge", "limit"),
+        ("admission_slots_peak", "Highest slot occupancy since process start.", "gauge", "peak_in_use"),
+        ("admission_admitted_total", "Requests admitted into a slot.", "counter", "total_admitted"),
+        ("admission_rejected_total", "Requests shed or queued because slots were full.", "counter", "total_rejected"),
+    ):
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}"]
+        for gate in gates:
+            lines.append(f'{metric}{{route_class="{gate.name}",pid="{pid}"}} {getattr(gate, attr)}')
+    return Response("\n".join(lines) + "\n", mimetype='text/plain')
+
+# --- Отчеты профилирования (только для администраторов) ---
+@app.route('/admin/profiles')
+@login_required
+def profile_reports():
+    if not user_is_admin(current_user):
+        abort(403)
+    reports = []
+    if os.path.isdir(PROFILE_REPORTS_DIR):
+        for name in sorted(os.listdir(PROFILE_REPORTS_DIR), reverse=True):
+            if name.endswith('.txt'):
+                base_name = name[:-len('.txt')]
+                with open(os.path.join(PROFILE_REPORTS_DIR, name), encoding='utf-8') as report_file:
+                    summary = [next(report_file, '').strip() for _ in range(7)]
+                reports.append({"name": base_name, "summary": summary})
+    return render_template('profile_reports.html', title='Профилирование запросов', reports=reports,
+                           profiling_enabled=bool(session.get('profile_requests')),
+                           sample_rate=PROFILE_SAMPLE_RATE, sampled_endpoints=sorted(PROFILE_SAMPLED_ENDPOINTS))
+
+@app.route('/admin/profiles/toggle', methods=['POST'])
+@login_required
+def toggle_request_profiling():
+    if not user_is_admin(current_user):
+        abort(403)
+    session['profile_requests'] = not session.get('profile_requests')
+    flash('Профилирование ваших запросов ' + ('включено.' if session['profile_requests'] else 'выключено.'), 'info')
+    return redirect(url_for('profile_reports'))
+
+@app.route('/admin/profiles/<path:filename>')
+@login_required
+def download_profile_report(filename):
+    if not user_is_admin(current_user):
+        abort(403)
+    if not (filename.endswith('.txt') or filename.endswith('.prof')):
+        abort(404)
+    return send_from_directory(PROFILE_REPORTS_DIR, filename, as_attachment=filename.endswith('.prof'))
 
 # --- Новые маршруты для аутентификации и управления ---
 @app.route("/register", methods=['GET', 'POST'])
@@ -547,8 +2586,8 @@ def register():
         return redirect(url_for('index'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
-        user = User(email=form.email.data, password_hash=hashed_password) # Используем email
+        user = User(email=form.email.data) # Используем email
+        user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
         flash('Ваша учетная запись создана! Теперь вы можете войти.', 'success')
@@ -562,8 +2601,15 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first() # Используем email
-        if user and bcrypt.check_password_hash(user.password_hash, form.password.data):
+        if user and user.check_password(form.password.data):
+            # Прозрачно пересчитываем хеш, если cost в конфигурации изменился
+            if user.password_needs_rehash(app.config['BCRYPT_LOG_ROUNDS']):
+                user.set_password(form.password.data)
+                db.session.commit()
+                print(f"BCRYPT: Rehashed password for user {user.email} with log rounds {app.config['BCRYPT_LOG_ROUNDS']}.")
             login_user(user, remember=form.remember.data)
+            # Пока браузер идет по редиректу, заказы уже загружаются в фоне
+            schedule_orders_warmup(orders_warmup_shops_for_login(user))
             next_page = request.args.get('next')
             flash('Вход выполнен успешно!', 'success')
             return redirect(next_page) if next_page else redirect(url_for('index'))
@@ -586,16 +2632,22 @@ def account():
                            ozon_shops=ozon_shops,
                            cdek_accounts=cdek_accounts) # Передаем аккаунты CDEK
 
+def fill_label_prefetch_choices(form):
+    cdek_accounts = CdekAccount.query.filter_by(user_id=current_user.id).order_by(CdekAccount.account_name).all()
+    form.label_prefetch_account_id.choices = [(0, 'Выключена')] + [(acc.id, acc.account_name) for acc in cdek_accounts]
+
 @app.route("/add_ozon_shop", methods=['GET', 'POST'])
 @login_required
 def add_ozon_shop():
     form = OzonShopForm()
+    fill_label_prefetch_choices(form)
     if form.validate_on_submit():
         new_shop = OzonShop(
             shop_name=form.shop_name.data,
             client_id=form.client_id.data,
             api_key=form.api_key.data,
             warehouse_name=form.warehouse_name.data if form.warehouse_name.data else "rFBS",
+            label_prefetch_account_id=form.label_prefetch_account_id.data or None,
             user_id=current_user.id
         )
         # Проверка, является ли этот магазин первым для пользователя
@@ -620,11 +2672,13 @@ def edit_ozon_shop(shop_id):
         return redirect(url_for('account'))
     
     form = OzonShopForm()
+    fill_label_prefetch_choices(form)
     if form.validate_on_submit():
         shop.shop_name = form.shop_name.data
         shop.client_id = form.client_id.data
         shop.api_key = form.api_key.data
         shop.warehouse_name = form.warehouse_name.data if form.warehouse_name.data else "rFBS"
+        shop.label_prefetch_account_id = form.label_prefetch_account_id.data or None
         db.session.commit()
         flash('Данные магазина Ozon обновлены.', 'success')
         return redirect(url_for('account'))
@@ -633,6 +2687,7 @@ def edit_ozon_shop(shop_id):
         form.client_id.data = shop.client_id
         form.api_key.data = shop.api_key
         form.warehouse_name.data = shop.warehouse_name
+        form.label_prefetch_account_id.data = shop.label_prefetch_account_id or 0
     return render_template('add_edit_ozon_shop.html', title='Редактировать магазин Ozon', form=form, legend=f'Редактировать: {shop.shop_name}')
 
 @app.route("/delete_ozon_shop/<int:shop_id>", methods=['POST']) # Используем POST для безопасности
@@ -647,6 +2702,7 @@ def delete_ozon_shop(shop_id):
     was_default = shop.is_default
     db.session.delete(shop)
     db.session.commit()
+    shutil.rmtree(archive_shop_dir(shop_id), ignore_errors=True) # id магазина может быть выдан повторно (SQLite)
     flash(f'Магазин Ozon "{shop.shop_name}" удален.', 'success')
 
     if was_default:
@@ -658,6 +2714,30 @@ def delete_ozon_shop(shop_id):
             
     return redirect(url_for('account'))
 
+@app.route("/enable_ozon_push/<int:shop_id>", methods=['POST'])
+@login_required
+def enable_ozon_push(shop_id):
+    shop = OzonShop.query.get_or_404(shop_id)
+    if shop.owner != current_user:
+        flash('У вас нет прав на это действие.', 'danger')
+        return redirect(url_for('account'))
+    shop.push_token = secrets.token_urlsafe(32)
+    db.session.commit()
+    flash(f'Push-уведомления для магазина "{shop.shop_name}" включены. Укажите адрес из таблицы в настройках уведомлений Ozon Seller.', 'success')
+    return redirect(url_for('account'))
+
+@app.route("/disable_ozon_push/<int:shop_id>", methods=['POST'])
+@login_required
+def disable_ozon_push(shop_id):
+    shop = OzonShop.query.get_or_404(shop_id)
+    if shop.owner != current_user:
+        flash('У вас нет прав на это действие.', 'danger')
+        return redirect(url_for('account'))
+    shop.push_token = None
+    db.session.commit()
+    flash(f'Push-уведомления для магазина "{shop.shop_name}" выключены.', 'info')
+    return redirect(url_for('account'))
+
 @app.route("/set_default_ozon_shop/<int:shop_id>", methods=['POST'])
 @login_required
 def set_default_ozon_shop(shop_id):
@@ -733,6 +2813,8 @@ def delete_cdek_account(account_id):
     
     was_default = cdek_account.is_default
     account_name_deleted = cdek_account.account_name
+    # Выключаем предзагрузку этикеток в магазинах, которые ссылались на этот аккаунт
+    OzonShop.query.filter_by(label_prefetch_account_id=cdek_account.id).update({"label_prefetch_account_id": None})
     db.session.delete(cdek_account)
     db.session.commit()
     flash(f'Аккаунт CDEK "{account_name_deleted}" удален.', 'success')
@@ -763,6 +2845,271 @@ def set_default_cdek_account(account_id):
     flash(f'Аккаунт CDEK "{account_to_set_default.account_name}" установлен по умолчанию.', 'success')
     return redirect(url_for('account'))
 
+# --- CLI команды ---
+@app.cli.command('bench-login')
+@click.option('--iterations', default=20, show_default=True, help='Количество проверок пароля на каждый cost.')
+@click.option('--min-rounds', default=None, type=int, help='Минимальный cost для сравнения (по умолчанию текущий).')
+@click.option('--max-rounds', default=None, type=int, help='Максимальный cost для сравнения (по умолчанию текущий).')
+@click.option('--target-ms', default=None, type=float, help='Подобрать cost, при котором один хеш укладывается в столько мс.')
+def bench_login(iterations, min_rounds, max_rounds, target_ms):
+    """Замеряет пропускную способность проверки пароля при входе для разных cost bcrypt."""
+    if target_ms is not None:
+        # Мерить на той же машине, где работают воркеры, и задать результат всем через BCRYPT_LOG_ROUNDS
+        calibrated_rounds = calibrate_bcrypt_log_rounds(target_ms)
+        click.echo(f"Для {target_ms:g} мс на хеш: BCRYPT_LOG_ROUNDS={calibrated_rounds}")
+    current_rounds = app.config['BCRYPT_LOG_ROUNDS']
+    min_rounds = min_rounds if min_rounds is not None else current_rounds
+    max_rounds = max_rounds if max_rounds is not None else current_rounds
+    click.echo(f"Текущий BCRYPT_LOG_ROUNDS: {current_rounds}")
+    for rounds in range(max(min_rounds, BCRYPT_MIN_LOG_ROUNDS), max_rounds + 1):
+        password_hash = bcrypt.generate_password_hash('bench-password', rounds=rounds)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            bcrypt.check_password_hash(password_hash, 'bench-password')
+        elapsed = time.perf_counter() - started
+        per_check_ms = elapsed * 1000 / iterations
+        click.echo(f"cost={rounds:2d}: {per_check_ms:8.1f} мс на вход, {iterations / elapsed:8.1f} входов/с на воркер")
+
+@app.cli.command('purge-label-requests')
+@click.option('--days', default=None, type=int, help='Срок хранения отметок в днях (по умолчанию LABEL_REQUEST_RETENTION_DAYS).')
+def purge_label_requests_command(days):
+    """Удаляет устаревшие отметки о запрошенных этикетках."""
+    deleted = purge_expired_label_requests(days)
+    expired = expire_prefetched_labels()
+    click.echo(f"Удалено отметок: {deleted}, просрочено предзагруженных этикеток: {expired}")
+
+@app.cli.command('reconcile-ozon-orders')
+@click.option('--all-shops', is_flag=True, help='Сверить все магазины, а не только с включенными push-уведомлениями.')
+@click.option('--force', is_flag=True, help='Сверить, даже если последняя сверка была недавно.')
+def reconcile_ozon_orders_command(all_shops, force):
+    """Полная сверка сохраненного состояния отправлений с Ozon (на случай пропущенных push-событий)."""
+    query = OzonShop.query if all_shops else OzonShop.query.filter(OzonShop.push_token.isnot(None))
+    for shop in query.all():
+        if not force and shop_orders_cache_is_fresh(shop):
+            click.echo(f"{shop.shop_name}: сверка не нужна (последняя {shop.orders_synced_at})")
+            continue
+        grouped_postings, error = sync_shop_postings(shop)
+        click.echo(f"{shop.shop_name}: {len(grouped_postings)} отправлений" + (f", ошибка: {error}" if error else ""))
+    click.echo(f"Удалено устаревших состояний отправлений: {purge_stale_posting_states()}")
+
+@app.cli.command('warm-ozon-orders')
+@click.option('--user-email', default=None, help='Прогреть магазины только этого пользователя.')
+@click.option('--default-only', is_flag=True, help='Только магазины по умолчанию.')
+@click.option('--fresh-minutes', default=None, type=int, help='Сколько прогретое состояние ждет первого показа (по умолчанию ORDERS_WARMUP_TTL_SECONDS).')
+def warm_ozon_orders_command(user_email, default_only, fresh_minutes):
+    """Плановый прогрев заказов перед сменой (запускать планировщиком, например за несколько минут до начала работы)."""
+    query = OzonShop.query
+    if user_email:
+        user = User.query.filter_by(email=user_email).first()
+        if not user:
+            raise click.ClickException(f"Пользователь {user_email} не найден.")
+        query = query.filter_by(user_id=user.id)
+    if default_only:
+        query = query.filter_by(is_default=True)
+    futures = schedule_orders_warmup(query.all(), fresh_seconds=fresh_minutes * 60 if fresh_minutes is not None else None)
+    for future in futures:
+        future.result()
+    click.echo(f"Выгрузок из Ozon: {len(futures)}")
+
+@app.cli.command('archive-ozon-postings')
+def archive_ozon_postings_command():
+    """Дописывает в архив отправления, сохраненные до включения архива (и пропущенные из-за ошибок записи)."""
+    total = 0
+    for shop in OzonShop.query.all():
+        archived = archive_pending_postings(shop)
+        total += archived
+        click.echo(f"{shop.shop_name}: в архив записано отправлений: {archived}")
+    click.echo(f"Всего: {total}")
+
+@app.cli.command('compact-postings-archive')
+def compact_postings_archive_command():
+    """Сливает мелкие part-файлы каждого раздела архива в один (запускать планировщиком, например раз в сутки)."""
+    partitions = merged_files = 0
+    if os.path.isdir(POSTINGS_ARCHIVE_DIR):
+        for shop_part in sorted(os.listdir(POSTINGS_ARCHIVE_DIR)):
+            shop_dir = os.path.join(POSTINGS_ARCHIVE_DIR, shop_part)
+            if not os.path.isdir(shop_dir):
+                continue
+            events_dir = os.path.join(shop_dir, 'events')
+            partition_dirs = [(os.path.join(shop_dir, name), ARCHIVE_ROW_KEY) for name in sorted(os.listdir(shop_dir)) if name.startswith('day=')]
+            if os.path.isdir(events_dir):
+                partition_dirs += [(os.path.join(events_dir, name), ARCHIVE_EVENT_COLUMNS) for name in sorted(os.listdir(events_dir))]
+            for partition_dir, row_key in partition_dirs:
+                merged = compact_archive_partition(partition_dir, row_key)
+                if merged:
+                    partitions += 1
+                    merged_files += merged
+    click.echo(f"Слито файлов: {merged_files} в {partitions} раздел(ах)")
+
+LABELS_MANIFEST_FILENAME = 'labels_manifest.jsonl'
+
+def load_labels_manifest(output_dir):
+    """Треки, PDF которых уже лежат в каталоге (по манифесту прошлых запусков; файл должен существовать)."""
+    done_tracks = set()
+    manifest_path = os.path.join(output_dir, LABELS_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return done_tracks
+    with open(manifest_path, encoding='utf-8') as manifest:
+        for line in manifest:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # недописанная строка прерванного запуска
+            if os.path.exists(os.path.join(output_dir, record["filename"])):
+                done_tracks.update(record["tracks"])
+    return done_tracks
+
+def write_label_chunk_file(track_numbers, pdf_content, output_dir):
+    # Файл пишется атомарно, чтобы прерванный запуск не оставил битый PDF
+    safe_first = track_numbers[0].replace('/', '-')
+    if len(track_numbers) == 1:
+        filename = f"cdek_label_{safe_first}.pdf"
+    else:
+        filename = f"cdek_labels_{safe_first}_{track_numbers[-1].replace('/', '-')}_{len(track_numbers)}orders.pdf"
+    path = os.path.join(output_dir, filename)
+    with open(path + '.part', 'wb') as f:
+        f.write(pdf_content)
+    os.replace(path + '.part', path)
+    return filename
+
+@app.cli.command('generate-labels')
+@click.option('--user-email', required=True, help='Пользователь, от имени которого запрашиваются этикетки.')
+@click.option('--shop', 'shop_name', default=None, help='Магазин Ozon (название или ID); по умолчанию магазин пользователя по умолчанию.')
+@click.option('--cdek-account', 'cdek_account_name', default=None, help='Аккаунт СДЭК (название или ID); по умолчанию аккаунт по умолчанию.')
+@click.option('--tracks-file', type=click.File('r', encoding='utf-8'), default=None, help='Файл с треками (по одному в строке) вместо выгрузки из Ozon.')
+@click.option('--output-dir', required=True, type=click.Path(file_okay=False), help='Каталог для PDF.')
+@click.option('--chunk-size', default=20, show_default=True, type=click.IntRange(1, MAX_CDEK_ORDERS_PER_BATCH), help='Треков в одном PDF.')
+@click.option('--only-new', is_flag=True, help='Пропустить треки, по которым этикетки уже запрашивались.')
+def generate_labels_command(user_email, shop_name, cdek_account_name, tracks_file, output_dir, chunk_size, only_new):
+    """Массовая выгрузка этикеток СДЭК в каталог: каждый PDF пишется на диск по готовности, повторный запуск докачивает недостающие.
+    Пачки идут через общую очередь планировщика, поэтому действуют те же лимиты на пользователя и аккаунт СДЭК, что и в приложении."""
+    user = User.query.filter_by(email=user_email).first()
+    if not user:
+        raise click.ClickException(f"Пользователь {user_email} не найден.")
+
+    def find_owned(model, name_field, value):
+        query = model.query.filter_by(user_id=user.id)
+        if value is None:
+            return query.filter_by(is_default=True).first() or query.first()
+        if value.isdigit():
+            found = query.filter_by(id=int(value)).first()
+            if found:
+                return found
+        return query.filter(getattr(model, name_field) == value).first()
+
+    cdek_account = find_owned(CdekAccount, 'account_name', cdek_account_name)
+    if not cdek_account:
+        raise click.ClickException("Аккаунт СДЭК не найден.")
+
+    if tracks_file:
+        track_numbers = [line.strip() for line in tracks_file if line.strip()]
+        click.echo(f"Треков в файле: {len(track_numbers)}")
+    else:
+        shop = find_owned(OzonShop, 'shop_name', shop_name)
+        if not shop:
+            raise click.ClickException("Магазин Ozon не найден.")
+        grouped_postings, error = sync_shop_postings(shop)
+        if error and not grouped_postings:
+            raise click.ClickException(f"Ozon: {error}")
+        grouped_postings.sort(key=lambda x: x["big_digits"])
+        track_numbers = [p["track_number"] for p in grouped_postings]
+        click.echo(f"{shop.shop_name}: отправлений awaiting_deliver: {len(grouped_postings)}" + (f" (ошибка: {error})" if error else ""))
+
+    track_numbers, skipped_tracks = normalize_label_tracks(track_numbers, cdek_account)
+    for skipped in skipped_tracks:
+        click.echo(f"Пропущен {skipped['track']}: {skipped['reason']}", err=True)
+    if only_new:
+        requested_tracks = get_requested_track_numbers(track_numbers, user.id)
+        track_numbers = [tn for tn in track_numbers if tn not in requested_tracks]
+    os.makedirs(output_dir, exist_ok=True)
+    done_tracks = load_labels_manifest(output_dir)
+    pending_tracks = [tn for tn in track_numbers if tn not in done_tracks]
+    chunks = [pending_tracks[i:i + chunk_size] for i in range(0, len(pending_tracks), chunk_size)]
+    click.echo(f"Треков: {len(track_numbers)}, уже в каталоге: {len(track_numbers) - len(pending_tracks)}, пачек к запросу: {len(chunks)}")
+    if not chunks:
+        return
+
+    # Пачки ставятся в ту же очередь, что и запросы из приложения: их может взять и планировщик этого процесса,
+    # и воркеры gunicorn, но одновременно для аккаунта СДЭК работает не больше LABEL_MAX_RUNNING_CHUNKS_PER_ACCOUNT
+    job = create_label_job(cdek_account, user.id, chunks, {}, [])
+    click.echo(f"Задача {job.id}: пачек в очереди {len(chunks)}")
+    failed = 0
+    written_tracks = 0
+    completed = 0
+    manifest_path = os.path.join(output_dir, LABELS_MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, 'a', encoding='utf-8') as manifest:
+            while True:
+                ensure_label_scheduler_started()
+                db.session.expire_all()
+                job_finished = job.status not in ('queued', 'running')
+                for chunk in job.chunks:
+                    if chunk.delivered_at or chunk.status not in ('done', 'failed'):
+                        continue
+                    completed += 1
+                    chunk_tracks = json.loads(chunk.track_numbers)
+                    if chunk.status == 'done':
+                        filename = write_label_chunk_file(chunk_tracks, chunk.pdf_content, output_dir)
+                        manifest.write(json.dumps({"filename": filename, "tracks": chunk_tracks}, ensure_ascii=False) + "\n")
+                        manifest.flush()
+                        written_tracks += len(chunk_tracks)
+                        click.echo(f"[{completed}/{len(chunks)}] {filename} ({len(chunk_tracks)} шт.)")
+                        chunk.pdf_content = None # PDF уже на диске, в базе его не держим
+                    else:
+                        failed += 1
+                        click.echo(f"[{completed}/{len(chunks)}] ОШИБКА {describe_label_chunk(chunk_tracks)}: {chunk.error}", err=True)
+                    chunk.delivered_at = datetime.utcnow()
+                    db.session.commit()
+                if job_finished:
+                    break
+                time.sleep(LABEL_JOB_WAIT_POLL_SECONDS)
+    except KeyboardInterrupt:
+        # Без этого оставшиеся пачки выполнили бы воркеры приложения, и PDF никто бы не забрал
+        db.session.rollback()
+        cancelled = LabelJobChunk.query.filter_by(job_id=job.id, status='queued').update(
+            {"status": "failed", "error": "Запуск generate-labels прерван", "finished_at": datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        finalize_label_job(job)
+        raise click.ClickException(f"Прервано: отменено пачек в очереди {cancelled}; повторный запуск запросит недостающие.")
+
+    click.echo(f"Готово: записано этикеток {written_tracks}, пачек с ошибкой {failed}. Каталог: {output_dir}")
+    if failed:
+        raise click.ClickException(f"{failed} пачек не получено; повторный запуск запросит только их.")
+
+@app.cli.command('ozon-push-send')
+@click.option('--shop-id', required=True, type=int, help='ID магазина Ozon в приложении.')
+@click.option('--type', 'message_type', default='state_changed', show_default=True,
+              type=click.Choice(['ping', 'new_posting', 'state_changed', 'cancelled']), help='Тип уведомления.')
+@click.option('--posting', 'posting_number', default=None, help='Номер отправления.')
+@click.option('--state', 'new_state', default='posting_awaiting_deliver', show_default=True, help='Новый статус для state_changed.')
+@click.option('--url', default=None, help='Базовый адрес приложения; без него уведомление отправляется в этот процесс.')
+def ozon_push_send_command(shop_id, message_type, posting_number, new_state, url):
+    """Локальная замена отправителя Ozon: шлет push-уведомление в эндпоинт приложения."""
+    shop = db.session.get(OzonShop, shop_id)
+    if not shop or not shop.push_token:
+        raise click.ClickException("Магазин не найден или push-уведомления для него не включены.")
+    now_str = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    message = {"message_type": f"TYPE_{message_type.upper()}"}
+    if message_type == 'ping':
+        message["time"] = now_str
+    else:
+        if not posting_number:
+            raise click.ClickException("Для этого типа уведомления нужен --posting.")
+        message.update({"posting_number": posting_number, "seller_id": shop.client_id, "changed_state_date": now_str})
+        if message_type == 'state_changed':
+            message["new_state"] = new_state
+        elif message_type == 'cancelled':
+            message["message_type"] = "TYPE_POSTING_CANCELLED"
+            message["new_state"] = {"id": 0, "name": "posting_cancelled"}
+    with app.test_request_context():
+        path = url_for('ozon_push', shop_id=shop.id, token=shop.push_token)
+    if url:
+        response_obj = requests.post(url.rstrip('/') + path, json=message, timeout=10)
+        click.echo(f"{response_obj.status_code} {response_obj.text}")
+    else:
+        response = app.test_client().post(path, json=message)
+        click.echo(f"{response.status_code} {response.get_data(as_text=True)}")
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
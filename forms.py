@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, BooleanField
+from wtforms import StringField, PasswordField, SubmitField, BooleanField, SelectField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
 # from app import User # Старый импорт
 from models import User # Новый импорт из models.py
@@ -42,6 +42,8 @@ class OzonShopForm(FlaskForm):
     api_key = StringField('API Key (Ozon)', validators=[DataRequired(), Length(max=200)])
     warehouse_name = StringField('Название склада Ozon (для rFBS, например rFBS_Москва_Ховрино)', 
                                  default='rFBS', validators=[Length(max=100)])
+    # Варианты (аккаунты СДЭК пользователя) заполняются в маршруте; 0 — предзагрузка выключена
+    label_prefetch_account_id = SelectField('Предзагрузка этикеток СДЭК для новых отправлений', coerce=int, default=0)
     submit = SubmitField('Сохранить магазин Ozon')
 
 class CdekAccountForm(FlaskForm):
@@ -1,9 +1,18 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_bcrypt import Bcrypt
 
-# Инициализация SQLAlchemy здесь, чтобы избежать циклических импортов
+# Инициализация SQLAlchemy и Bcrypt здесь, чтобы избежать циклических импортов
 db = SQLAlchemy()
+bcrypt = Bcrypt()
+
+def bcrypt_hash_rounds(password_hash):
+    # Хеш bcrypt имеет вид $2b$12$<salt+hash>, cost хранится во втором поле
+    try:
+        return int(password_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
@@ -16,11 +25,15 @@ class User(db.Model, UserMixin):
     def __repr__(self):
         return f"User('{self.email}')"
 
-    def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+    def set_password(self, password, rounds=None):
+        self.password_hash = bcrypt.generate_password_hash(password, rounds=rounds).decode('utf-8')
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return bcrypt.check_password_hash(self.password_hash, password)
+
+    def password_needs_rehash(self, rounds):
+        # Хеш нужно пересчитать, если он создан с другим cost (или вообще не bcrypt)
+        return bcrypt_hash_rounds(self.password_hash) != rounds
 
 class OzonShop(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -30,6 +43,16 @@ class OzonShop(db.Model):
     warehouse_name = db.Column(db.String(100), nullable=True, default="rFBS")
     is_default = db.Column(db.Boolean, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Аккаунт СДЭК для фоновой предзагрузки этикеток новых отправлений (None — предзагрузка выключена)
+    label_prefetch_account_id = db.Column(db.Integer, db.ForeignKey('cdek_account.id'), nullable=True)
+    # Секрет в URL push-уведомлений Ozon (None — push выключен) и время последней полной сверки с Ozon
+    push_token = db.Column(db.String(64), nullable=True)
+    orders_synced_at = db.Column(db.DateTime, nullable=True)
+    # До этого момента состояние, загруженное прогревом (вход пользователя, плановый прогрев), считается свежим
+    orders_warmed_until = db.Column(db.DateTime, nullable=True)
+
+    label_prefetch_account = db.relationship('CdekAccount', foreign_keys=[label_prefetch_account_id])
+    posting_states = db.relationship('OzonPostingState', backref='shop', lazy=True, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f"OzonShop('{self.shop_name}', UserID: {self.user_id})"
@@ -42,5 +65,128 @@ class CdekAccount(db.Model):
     is_default = db.Column(db.Boolean, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    label_requests = db.relationship('LabelRequest', backref='cdek_account', lazy=True, cascade="all, delete-orphan")
+    prefetched_labels = db.relationship('PrefetchedLabel', backref='cdek_account', lazy=True, cascade="all, delete-orphan")
+    label_jobs = db.relationship('LabelJob', backref='cdek_account', lazy=True, cascade="all, delete-orphan")
+    rejected_tracks = db.relationship('RejectedTrack', backref='cdek_account', lazy=True, cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return f"CdekAccount('{self.account_name}', UserID: {self.user_id})" 
+
+class LabelRequest(db.Model):
+    # Отметка о том, что этикетка СДЭК по треку уже запрашивалась (общая для всех операторов)
+    id = db.Column(db.Integer, primary_key=True)
+    track_number = db.Column(db.String(64), nullable=False)
+    cdek_account_id = db.Column(db.Integer, db.ForeignKey('cdek_account.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    requested_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('cdek_account_id', 'track_number', name='uq_label_request_account_track'),
+        db.Index('ix_label_request_track_number', 'track_number'),
+    )
+
+    def __repr__(self):
+        return f"LabelRequest('{self.track_number}', CdekAccountID: {self.cdek_account_id})"
+
+
+class PrefetchedLabel(db.Model):
+    # Заранее полученная в фоне этикетка СДЭК по одному треку; треки одной печатной формы СДЭК делят batch_key,
+    # а общий PDF хранится в записи пачки с наименьшим id
+    id = db.Column(db.Integer, primary_key=True)
+    track_number = db.Column(db.String(64), nullable=False)
+    cdek_account_id = db.Column(db.Integer, db.ForeignKey('cdek_account.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='pending') # pending / running / ready / failed / expired
+    pdf_content = db.Column(db.LargeBinary, nullable=True)
+    error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    ready_at = db.Column(db.DateTime, nullable=True)
+    printed_at = db.Column(db.DateTime, nullable=True)
+    batch_key = db.Column(db.String(32), nullable=True, index=True)
+    started_at = db.Column(db.DateTime, nullable=True) # когда пачку взяли в работу (для поиска брошенных)
+
+    __table_args__ = (
+        db.UniqueConstraint('cdek_account_id', 'track_number', name='uq_prefetched_label_account_track'),
+    )
+
+    def __repr__(self):
+        return f"PrefetchedLabel('{self.track_number}', '{self.status}', CdekAccountID: {self.cdek_account_id})"
+
+
+class OzonPostingState(db.Model):
+    # Последнее известное состояние отправления: из полной выгрузки Ozon или из push-уведомления
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('ozon_shop.id', ondelete='CASCADE'), nullable=False)
+    posting_number = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(64), nullable=False)
+    data = db.Column(db.Text, nullable=True) # JSON отправления в формате grouped_postings
+    source = db.Column(db.String(16), nullable=False, default='fetch') # fetch / push
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    archived_at = db.Column(db.DateTime, nullable=True) # когда отправление записано в колоночный архив
+
+    __table_args__ = (
+        db.UniqueConstraint('shop_id', 'posting_number', name='uq_ozon_posting_state_shop_posting'),
+        db.Index('ix_ozon_posting_state_shop_status', 'shop_id', 'status'),
+    )
+
+    def __repr__(self):
+        return f"OzonPostingState('{self.posting_number}', '{self.status}', ShopID: {self.shop_id})"
+
+
+class LabelJob(db.Model):
+    # Задача на получение этикеток: выполняется планировщиком по пачкам, пользователь опрашивает статус
+    id = db.Column(db.String(32), primary_key=True) # uuid4().hex
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    cdek_account_id = db.Column(db.Integer, db.ForeignKey('cdek_account.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='queued') # queued / running / done / partial / failed
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    skipped_tracks = db.Column(db.Text, nullable=True) # JSON [{track, reason}] — треки, отсеянные до постановки в очередь
+
+    chunks = db.relationship('LabelJobChunk', backref='job', lazy=True, cascade="all, delete-orphan",
+                             order_by='LabelJobChunk.chunk_index')
+
+    def __repr__(self):
+        return f"LabelJob('{self.id}', '{self.status}', UserID: {self.user_id})"
+
+
+class LabelJobChunk(db.Model):
+    # Пачка треков (до MAX_CDEK_ORDERS_PER_BATCH) — единица планирования; user_id и cdek_account_id
+    # продублированы из задачи, чтобы планировщик считал лимиты без join
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(32), db.ForeignKey('label_job.id', ondelete='CASCADE'), nullable=False, index=True)
+    chunk_index = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    cdek_account_id = db.Column(db.Integer, nullable=False)
+    track_numbers = db.Column(db.Text, nullable=False) # JSON-список треков
+    status = db.Column(db.String(16), nullable=False, default='queued') # queued / running / done / failed
+    pdf_content = db.Column(db.LargeBinary, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    print_uuid = db.Column(db.String(64), nullable=True) # UUID печатной формы СДЭК: после дедлайна опрос продолжается с него
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    delivered_at = db.Column(db.DateTime, nullable=True) # когда PDF пачки отдан пользователю
+
+    __table_args__ = (
+        db.Index('ix_label_job_chunk_status_user', 'status', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f"LabelJobChunk('{self.job_id}', #{self.chunk_index}, '{self.status}')"
+
+
+class RejectedTrack(db.Model):
+    # Трек, который СДЭК недавно отклонил (INVALID / ошибка 400): до истечения TTL не отправляется в новые пачки
+    id = db.Column(db.Integer, primary_key=True)
+    track_number = db.Column(db.String(64), nullable=False)
+    cdek_account_id = db.Column(db.Integer, db.ForeignKey('cdek_account.id', ondelete='CASCADE'), nullable=False)
+    reason = db.Column(db.Text, nullable=True)
+    rejected_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('cdek_account_id', 'track_number', name='uq_rejected_track_account_track'),
+    )
+
     def __repr__(self):
-        return f"CdekAccount('{self.account_name}', UserID: {self.user_id})" 
\ No newline at end of file
+        return f"RejectedTrack('{self.track_number}', CdekAccountID: {self.cdek_account_id})"
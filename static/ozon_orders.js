@@ -1,10 +1,10 @@
 document.addEventListener('DOMContentLoaded', function () {
+    // Таблицы может не быть (нет заказов в текущем магазине) — поиск по всем магазинам работает и без нее
     const table = document.getElementById('ozonOrdersTable');
-    if (!table) return; 
 
     const filterInputs = document.querySelectorAll('#filterRow input[type="text"]');
-    const tbody = table.querySelector('tbody');
-    let tableRows = Array.from(tbody.querySelectorAll('tr')); 
+    const tbody = table ? table.querySelector('tbody') : null;
+    let tableRows = tbody ? Array.from(tbody.querySelectorAll('tr')) : []; 
     const selectAllCheckbox = document.getElementById('selectAllRows');
     const rowSelectorCheckboxes = document.querySelectorAll('.row-selector');
     const getCdekLabelsBtn = document.getElementById('getCdekLabelsBtn');
@@ -15,43 +15,41 @@ document.addEventListener('DOMContentLoaded', function () {
     const SELECTED_ORDERS_INFO_SPAN = document.getElementById("selectedOrdersInfo");
     const HIGHLIGHT_DUPLICATES_TOGGLE = document.getElementById("highlightDuplicatesToggle");
 
-    const REQUESTED_LABELS_STORAGE_KEY = 'requestedCdekLabels';
-
-    function getRequestedLabels() {
-        const stored = localStorage.getItem(REQUESTED_LABELS_STORAGE_KEY);
-        return stored ? JSON.parse(stored) : [];
-    }
+    // Отметки о запрошенных этикетках приходят с сервера в data-label-requested каждой строки
+    const requestedLabels = new Set(
+        tableRows.filter(row => row.dataset.labelRequested === '1')
+                 .map(row => row.dataset.ozonTrackNumber)
+                 .filter(tn => tn)
+    );
 
     function storeMultipleRequestedLabels(trackNumbers) {
         if (!trackNumbers || trackNumbers.length === 0) return;
-        const current = getRequestedLabels();
-        let updated = false;
+        // Сервер уже сохранил отметки при выдаче этикеток, здесь только обновляем локальное состояние
         trackNumbers.forEach(trackNumber => {
-            if (trackNumber && !current.includes(trackNumber)) {
-                current.push(trackNumber);
-                updated = true;
-            }
+            if (trackNumber) requestedLabels.add(trackNumber);
         });
-        if (updated) {
-            localStorage.setItem(REQUESTED_LABELS_STORAGE_KEY, JSON.stringify(current));
-        }
     }
 
     function clearAllRequestedLabels() {
-        localStorage.removeItem(REQUESTED_LABELS_STORAGE_KEY);
-        applyRowHighlighting();
-        displayUserMessage("Отметки о запрошенных этикетках сброшены.", "success");
+        return fetch(clearRequestedLabelsUrl, {
+            method: 'POST',
+            headers: { 'X-CSRFToken': csrfToken }
+        })
+        .then(response => {
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            requestedLabels.clear();
+            applyRowHighlighting();
+            displayUserMessage("Отметки о запрошенных этикетках сброшены.", "success");
+        })
+        .catch(error => {
+            displayUserMessage(`Не удалось сбросить отметки: ${error}`, "error");
+        });
     }
 
     function applyRowHighlighting() {
-        const requested = getRequestedLabels();
-        document.querySelectorAll("table tbody tr").forEach(row => {
+        tableRows.forEach(row => {
             const trackNumber = row.dataset.ozonTrackNumber;
-            if (trackNumber && requested.includes(trackNumber)) {
-                row.classList.add('label-requested');
-            } else {
-                row.classList.remove('label-requested');
-            }
+            row.classList.toggle('label-requested', Boolean(trackNumber && requestedLabels.has(trackNumber)));
         });
     }
     
@@ -72,18 +70,35 @@ document.addEventListener('DOMContentLoaded', function () {
         }, 7000);
     }
 
+    // Индекс строк таблицы: строится один раз при загрузке, фильтры работают по нему, а не по DOM
+    const FILTER_DEBOUNCE_MS = 150;
+    const columnIndexByName = {};
+    Array.from(table ? table.querySelectorAll('thead tr:first-child th') : []).forEach((th, i) => {
+        columnIndexByName[th.textContent.trim()] = i;
+    });
+    const rowIndex = tableRows.map(row => ({
+        row: row,
+        checkbox: row.querySelector('.row-selector'),
+        cellTexts: Array.from(row.cells).map(cell => cell.textContent.toLowerCase()),
+        trackNumber: row.dataset.ozonTrackNumber,
+        isDuplicateTrack: row.dataset.duplicateTrack === '1',
+        visible: row.style.display !== 'none'
+    }));
+
+    function visibleRowEntries() {
+        return rowIndex.filter(entry => entry.visible);
+    }
+
     function updateGetLabelsButtonState() {
-        const anySelected = Array.from(document.querySelectorAll('.row-selector:checked'))
-                               .filter(cb => cb.closest('tr').style.display !== 'none') 
-                               .length > 0;
+        const anySelected = rowIndex.some(entry => entry.visible && entry.checkbox.checked);
         if (getCdekLabelsBtn) getCdekLabelsBtn.disabled = !anySelected;
         updateSelectedOrdersDisplay();
     }
 
     function updateSelectAllCheckboxState() {
         if (!selectAllCheckbox) return;
-        const visibleRows = Array.from(tbody.querySelectorAll('tr')).filter(r => r.style.display !== 'none');
-        const visibleSelectedRows = visibleRows.filter(r => r.querySelector('.row-selector').checked).length;
+        const visibleRows = visibleRowEntries();
+        const visibleSelectedRows = visibleRows.filter(entry => entry.checkbox.checked).length;
         
         if (visibleRows.length === 0) {
             selectAllCheckbox.checked = false;
@@ -104,8 +119,8 @@ document.addEventListener('DOMContentLoaded', function () {
     function updateSelectedOrdersDisplay() {
         if (!SELECTED_ORDERS_INFO_SPAN) return;
 
-        const visibleRows = Array.from(tbody.querySelectorAll('tr')).filter(r => r.style.display !== 'none');
-        const selectedVisibleRowsCount = visibleRows.filter(r => r.querySelector('.row-selector').checked).length;
+        const visibleRows = visibleRowEntries();
+        const selectedVisibleRowsCount = visibleRows.filter(entry => entry.checkbox.checked).length;
         const totalVisibleRowsCount = visibleRows.length;
 
         if (totalVisibleRowsCount > 0) {
@@ -118,10 +133,8 @@ document.addEventListener('DOMContentLoaded', function () {
     if (selectAllCheckbox) {
         selectAllCheckbox.addEventListener('change', function () {
             const isChecked = this.checked;
-            Array.from(tbody.querySelectorAll('tr')).forEach(row => {
-                if (row.style.display !== 'none') { 
-                    row.querySelector('.row-selector').checked = isChecked;
-                }
+            visibleRowEntries().forEach(entry => {
+                entry.checkbox.checked = isChecked;
             });
             updateGetLabelsButtonState();
         });
@@ -134,123 +147,232 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     });
 
-    filterInputs.forEach(input => {
-        input.addEventListener('keyup', function () {
-            const columnName = this.dataset.columnName;
-            const filterValue = this.value.toLowerCase();
-            let rowsToProcess = tbody.querySelectorAll('tr');
-
-            rowsToProcess.forEach(row => {
-                let cellText = '';
-                const headerCells = Array.from(table.querySelectorAll('thead th'));
-                let columnIndex = -1;
-                for(let i=0; i < headerCells.length; i++){
-                    if(headerCells[i].textContent.trim() === columnName){
-                        columnIndex = i;
-                        break;
-                    }
-                }
-                
-                if(columnIndex !== -1 && row.cells.length > columnIndex){
-                    const dataCellIndex = columnIndex; 
-                    if (row.cells[dataCellIndex]) { 
-                         cellText = row.cells[dataCellIndex].textContent.toLowerCase() || row.cells[dataCellIndex].innerText.toLowerCase();
+    // Все фильтры (колонки, статус скачивания, дубликаты) применяются за один проход по индексу
+    function masterFilter() {
+        const downloadFilterValue = DOWNLOAD_STATUS_FILTER_SELECT ? DOWNLOAD_STATUS_FILTER_SELECT.value : "all";
+        const duplicatesOnly = Boolean(HIGHLIGHT_DUPLICATES_TOGGLE && HIGHLIGHT_DUPLICATES_TOGGLE.checked);
+        const columnFilters = Array.from(filterInputs)
+            .map(input => ({
+                value: input.value.toLowerCase(),
+                columnIndex: columnIndexByName[input.dataset.columnName]
+            }))
+            .filter(filter => filter.value && filter.columnIndex !== undefined);
+
+        const changedEntries = [];
+        rowIndex.forEach(entry => {
+            let displayRow = true;
+
+            const isDownloaded = Boolean(entry.trackNumber && requestedLabels.has(entry.trackNumber));
+            if (downloadFilterValue === "downloaded" && !isDownloaded) {
+                displayRow = false;
+            } else if (downloadFilterValue === "not_downloaded" && isDownloaded) {
+                displayRow = false;
+            } else if (duplicatesOnly && !entry.isDuplicateTrack) {
+                displayRow = false;
+            } else {
+                for (const filter of columnFilters) {
+                    const cellText = entry.cellTexts[filter.columnIndex];
+                    if (cellText !== undefined && !cellText.includes(filter.value)) {
+                        displayRow = false;
+                        break; 
                     }
                 }
+            }
 
-                if (cellText.includes(filterValue)) {
-                    row.style.display = "";
-                } else {
-                    row.style.display = "none";
-                }
-            });
+            if (entry.visible !== displayRow) {
+                entry.visible = displayRow;
+                changedEntries.push(entry);
+            }
         });
-    });
 
-    // Функция для ФИЛЬТРАЦИИ по дубликатам трек-номеров
-    function filterByDuplicateTracks() { 
-        if (!HIGHLIGHT_DUPLICATES_TOGGLE || !tbody) return;
-
-        const potentiallyVisibleRows = Array.from(tbody.querySelectorAll('tr')).filter(r => r.style.display !== 'none');
-
-        if (HIGHLIGHT_DUPLICATES_TOGGLE.checked) {
-            const trackNumberCounts = {};
-            potentiallyVisibleRows.forEach(row => {
-                const trackNumber = row.dataset.ozonTrackNumber;
-                if (trackNumber) {
-                    trackNumberCounts[trackNumber] = (trackNumberCounts[trackNumber] || 0) + 1;
-                }
-            });
-            const duplicateTrackNumbers = Object.keys(trackNumberCounts).filter(tn => trackNumberCounts[tn] > 1);
-            potentiallyVisibleRows.forEach(row => {
-                const trackNumber = row.dataset.ozonTrackNumber;
-                if (!trackNumber || !duplicateTrackNumbers.includes(trackNumber)) {
-                    row.style.display = 'none'; 
-                }
+        // Меняем DOM только у строк, видимость которых изменилась, одной пачкой и без чтения layout
+        if (changedEntries.length > 0) {
+            window.requestAnimationFrame(() => {
+                changedEntries.forEach(entry => {
+                    entry.row.style.display = entry.visible ? "" : "none";
+                });
             });
         }
-        // Если чекбокс не нажат, masterFilter уже обеспечил правильную видимость.
+
+        // Счетчики и кнопки считаются по индексу, поэтому не ждут обновления DOM
+        updateSelectAllCheckboxState(); 
+        updateGetLabelsButtonState();
     }
 
-    function masterFilter() {
-        const requestedLabels = getRequestedLabels();
-        const downloadFilterValue = DOWNLOAD_STATUS_FILTER_SELECT.value;
-        const columnFilters = Array.from(filterInputs).map(input => ({
-            value: input.value.toLowerCase(),
-            columnName: input.dataset.columnName
-        }));
+    let filterDebounceTimer = null;
+    function scheduleMasterFilter() {
+        clearTimeout(filterDebounceTimer);
+        filterDebounceTimer = setTimeout(masterFilter, FILTER_DEBOUNCE_MS);
+    }
+    
+    applyRowHighlighting();
+    masterFilter(); 
 
-        const allDomRows = Array.from(tbody.querySelectorAll('tr')); 
+    const LABEL_JOB_POLL_INTERVAL_MS = 2000;
+    const LABEL_BUSY_MAX_RETRIES = 5;
+    const LOADER_DEFAULT_TEXT = LOADER_DIV ? LOADER_DIV.textContent : '';
 
-        allDomRows.forEach(row => {
-            let displayRow = true;
+    function describeLabelJob(job) {
+        if (job.queue_position !== null && job.queue_position !== undefined && job.running_chunks === 0) {
+            return `Этикетки в очереди. Перед вами пачек: ${job.queue_position}.`;
+        }
+        const finishedChunks = job.done_chunks + job.failed_chunks;
+        return `Получение этикеток: готово пачек ${finishedChunks} из ${job.total_chunks}.`;
+    }
 
-            const trackNumber = row.dataset.ozonTrackNumber;
-            const isDownloaded = trackNumber && requestedLabels.includes(trackNumber);
-            if (downloadFilterValue === "downloaded" && !isDownloaded) {
-                displayRow = false;
-            }
-            if (downloadFilterValue === "not_downloaded" && isDownloaded) {
-                displayRow = false;
+    // Сервер отвечает 503 с Retry-After, когда все слоты этикеток заняты; повторяем через указанное время
+    function fetchWhenAdmitted(url, attemptsLeft = LABEL_BUSY_MAX_RETRIES) {
+        return fetch(url).then(response => {
+            if (response.status !== 503 || !response.headers.get('Retry-After') || attemptsLeft <= 0) return response;
+            const retryAfterMs = (parseInt(response.headers.get('Retry-After'), 10) || 5) * 1000;
+            return new Promise(resolve => setTimeout(resolve, retryAfterMs))
+                .then(() => fetchWhenAdmitted(url, attemptsLeft - 1));
+        });
+    }
+
+    // Крупные выборки обрабатываются на сервере очередью; опрашиваем статус и забираем файл по готовности
+    function pollLabelJob(job) {
+        if (LOADER_DIV) LOADER_DIV.textContent = describeLabelJob(job);
+        if (['queued', 'running'].includes(job.status)) {
+            return new Promise(resolve => setTimeout(resolve, LABEL_JOB_POLL_INTERVAL_MS))
+                .then(() => fetch(job.status_url))
+                .then(response => {
+                    if (!response.ok) throw new Error(`статус задачи недоступен (${response.status})`);
+                    return response.json();
+                })
+                .then(pollLabelJob);
+        }
+        return fetchWhenAdmitted(job.download_url).then(response => {
+            if (LOADER_DIV) {
+                LOADER_DIV.style.display = 'none';
+                LOADER_DIV.textContent = LOADER_DEFAULT_TEXT;
             }
+            handleLabelsResponse(response, job.requested_tracks || []);
+        });
+    }
 
-            if (displayRow) {
-                const headerCells = Array.from(table.querySelectorAll('thead tr:first-child th'));
-                for (const filter of columnFilters) {
-                    if (filter.value) { 
-                        let columnIndex = -1;
-                        for (let i = 0; i < headerCells.length; i++) {
-                            if (headerCells[i].textContent.trim() === filter.columnName) {
-                                columnIndex = i;
-                                break;
-                            }
-                        }
-                        if (columnIndex !== -1) {
-                            const cell = row.cells[columnIndex];
-                            if (cell) {
-                                const cellText = (cell.textContent || cell.innerText).toLowerCase();
-                                if (!cellText.includes(filter.value)) {
-                                    displayRow = false;
-                                    break; 
-                                }
-                            }
-                        }
+    // Треки, отсеянные сервером до запроса в СДЭК (формат, недавний отказ СДЭК), с причиной по каждому
+    function displaySkippedTracks(skipped) {
+        if (!skipped || skipped.length === 0) return;
+        const skippedDiv = document.createElement('div');
+        skippedDiv.className = 'alert alert-warning';
+        skippedDiv.setAttribute('role', 'alert');
+        const title = document.createElement('div');
+        title.textContent = `Пропущено треков: ${skipped.length}`;
+        skippedDiv.appendChild(title);
+        const list = document.createElement('ul');
+        list.className = 'mb-0';
+        skipped.forEach(item => {
+            const li = document.createElement('li');
+            li.textContent = `${item.track}: ${item.reason}`;
+            list.appendChild(li);
+        });
+        skippedDiv.appendChild(list);
+        USER_MESSAGES_DIV.appendChild(skippedDiv);
+    }
+
+    function skippedFromHeader(response) {
+        try {
+            return JSON.parse(response.headers.get('X-Label-Skipped') || '[]');
+        } catch (e) {
+            return [];
+        }
+    }
+
+    function handleLabelsResponse(response, trackNumbers) {
+        const contentType = response.headers.get("content-type");
+        if (response.ok && contentType) {
+            if (contentType.includes("application/pdf")) {
+                storeMultipleRequestedLabels(trackNumbers);
+                applyRowHighlighting(); 
+                displayUserMessage("Запрос на этикетки успешно обработан. Начинается загрузка PDF.", "success");
+                displaySkippedTracks(skippedFromHeader(response));
+                response.blob().then(blob => {
+                    const url = window.URL.createObjectURL(blob);
+                    const a = document.createElement('a');
+                    a.href = url;
+                    a.download = `cdek_labels_${trackNumbers.length}_orders.pdf`;
+                    document.body.appendChild(a);
+                    a.click();
+                    a.remove();
+                    window.URL.revokeObjectURL(url);
+                });
+            } else if (contentType.includes("application/zip")) {
+                storeMultipleRequestedLabels(trackNumbers);
+                applyRowHighlighting();
+                displayUserMessage("Запрос на этикетки успешно обработан. Начинается загрузка ZIP архива.", "success");
+                displaySkippedTracks(skippedFromHeader(response));
+                response.blob().then(blob => {
+                    const url = window.URL.createObjectURL(blob);
+                    const a = document.createElement('a');
+                    a.href = url;
+                    a.download = `cdek_labels_batch_${Date.now()}.zip`;
+                    document.body.appendChild(a);
+                    a.click();
+                    a.remove();
+                    window.URL.revokeObjectURL(url);
+                });
+            } else if (contentType.includes("application/json")) {
+                response.json().then(data => {
+                    if(data.error){
+                        displayUserMessage(`Ошибка: ${data.error}`, "error");
+                    } else if (data.message) {
+                        displayUserMessage(data.message, "success"); 
+                        storeMultipleRequestedLabels(trackNumbers); 
+                        applyRowHighlighting();
+                    } else {
+                        displayUserMessage("Неожиданный JSON ответ от сервера.", "error");
                     }
-                }
+                    displaySkippedTracks(data.skipped);
+                });
+            } else {
+                displayUserMessage("Неподдерживаемый тип ответа от сервера: " + contentType, "error");
             }
-            row.style.display = displayRow ? "" : "none";
-        });
-        
-        filterByDuplicateTracks(); // Применяем фильтр дубликатов ПОСЛЕ основных
+        } else {
+            response.json().then(data => {
+                displayUserMessage(`Ошибка (${response.status}): ${data.error || data.message || 'Не удалось получить этикетки.'}`, "error");
+                displaySkippedTracks(data.skipped);
+            }).catch(() => {
+                 response.text().then(text => {
+                    displayUserMessage(`Ошибка (${response.status}): ${text || 'Не удалось получить этикетки.'}`, "error");
+                });
+            });
+        }
+    }
 
-        // Обновляем состояния кнопок и счетчиков в самом конце, ПОСЛЕ ВСЕХ фильтраций
-        updateSelectedOrdersDisplay(); 
-        updateSelectAllCheckboxState(); 
-        updateGetLabelsButtonState(); // Добавлено обновление состояния кнопки здесь
+    function requestLabels(trackNumbers) {
+        if (LOADER_DIV) LOADER_DIV.style.display = 'block';
+        USER_MESSAGES_DIV.innerHTML = '';
+
+        fetch(getCdekLabelsUrl, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': csrfToken
+            },
+            body: JSON.stringify({ ozon_tracking_numbers: trackNumbers })
+        })
+        .then(response => {
+            if (response.status === 202) {
+                // Сервер не уложился в бюджет запроса: забираем уже готовые пачки и ждем остальные
+                return response.json().then(job => {
+                    const readyDownload = job.ready_download_url
+                        ? fetchWhenAdmitted(job.ready_download_url).then(readyResponse => handleLabelsResponse(readyResponse, job.ready_tracks))
+                        : Promise.resolve();
+                    return readyDownload.then(() => pollLabelJob(job));
+                });
+            }
+            if (LOADER_DIV) LOADER_DIV.style.display = 'none';
+            handleLabelsResponse(response, trackNumbers);
+        })
+        .catch(error => {
+            if (LOADER_DIV) {
+                LOADER_DIV.style.display = 'none';
+                LOADER_DIV.textContent = LOADER_DEFAULT_TEXT;
+            }
+            displayUserMessage(`Сетевая ошибка или ошибка обработки запроса: ${error}`, "error");
+        });
     }
-    
-    applyRowHighlighting();
-    masterFilter(); 
 
     if (getCdekLabelsBtn) {
         getCdekLabelsBtn.addEventListener('click', function () {
@@ -262,91 +384,98 @@ document.addEventListener('DOMContentLoaded', function () {
                 displayUserMessage("Пожалуйста, выберите заказы для получения этикеток.", "error");
                 return;
             }
+            requestLabels(trackNumbers);
+        });
+    }
 
-            if (LOADER_DIV) LOADER_DIV.style.display = 'block';
-            USER_MESSAGES_DIV.innerHTML = '';
-
-            fetch(getCdekLabelsUrl, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'X-CSRFToken': csrfToken
-                },
-                body: JSON.stringify({ ozon_tracking_numbers: trackNumbers })
-            })
-            .then(response => {
-                if (LOADER_DIV) LOADER_DIV.style.display = 'none';
-                const contentType = response.headers.get("content-type");
-                if (response.ok && contentType) {
-                    if (contentType.includes("application/pdf")) {
-                        storeMultipleRequestedLabels(trackNumbers);
-                        applyRowHighlighting(); 
-                        displayUserMessage("Запрос на этикетки успешно обработан. Начинается загрузка PDF.", "success");
-                        response.blob().then(blob => {
-                            const url = window.URL.createObjectURL(blob);
-                            const a = document.createElement('a');
-                            a.href = url;
-                            a.download = `cdek_labels_${trackNumbers.length}_orders.pdf`;
-                            document.body.appendChild(a);
-                            a.click();
-                            a.remove();
-                            window.URL.revokeObjectURL(url);
-                        });
-                    } else if (contentType.includes("application/zip")) {
-                        storeMultipleRequestedLabels(trackNumbers);
-                        applyRowHighlighting();
-                        displayUserMessage("Запрос на этикетки успешно обработан. Начинается загрузка ZIP архива.", "success");
-                        response.blob().then(blob => {
-                            const url = window.URL.createObjectURL(blob);
-                            const a = document.createElement('a');
-                            a.href = url;
-                            a.download = `cdek_labels_batch_${Date.now()}.zip`;
-                            document.body.appendChild(a);
-                            a.click();
-                            a.remove();
-                            window.URL.revokeObjectURL(url);
-                        });
-                    } else if (contentType.includes("application/json")) {
-                        response.json().then(data => {
-                            if(data.error){
-                                displayUserMessage(`Ошибка: ${data.error}`, "error");
-                            } else if (data.message) {
-                                displayUserMessage(data.message, "success"); 
-                                storeMultipleRequestedLabels(trackNumbers); 
-                                applyRowHighlighting();
-                            } else {
-                                displayUserMessage("Неожиданный JSON ответ от сервера.", "error");
-                            }
-                        });
-                    } else {
-                        displayUserMessage("Неподдерживаемый тип ответа от сервера: " + contentType, "error");
-                    }
-                } else {
-                    response.json().then(data => {
-                        displayUserMessage(`Ошибка (${response.status}): ${data.error || 'Не удалось получить этикетки.'}`, "error");
-                    }).catch(() => {
-                         response.text().then(text => {
-                            displayUserMessage(`Ошибка (${response.status}): ${text || 'Не удалось получить этикетки.'}`, "error");
-                        });
-                    });
+    // Поиск по всем магазинам пользователя (серверный индекс), с получением этикетки прямо из результатов
+    const SEARCH_DEBOUNCE_MS = 200;
+    const SEARCH_INPUT = document.getElementById('crossShopSearch');
+    const SEARCH_RESULTS_DIV = document.getElementById('crossShopSearchResults');
+    const SEARCH_COLUMNS = [
+        ['shop_name', 'Магазин'], ['posting_number', 'Номер отправления'], ['track_number', 'Трек-номер'],
+        ['big_digits', '4 Большие цифры'], ['order_date', 'Дата заказа'], ['offer_ids', 'Артикулы'], ['status', 'Статус']
+    ];
+    let searchDebounceTimer = null;
+    let searchRequestSeq = 0;
+
+    function renderSearchResults(data) {
+        SEARCH_RESULTS_DIV.innerHTML = '';
+        const info = document.createElement('small');
+        info.className = 'text-muted d-block mb-1';
+        if (data.message) {
+            info.textContent = data.message;
+        } else {
+            info.textContent = `Найдено: ${data.results.length}${data.truncated ? '+' : ''} (${data.took_ms} мс)`;
+            if (data.unsynced_shops && data.unsynced_shops.length) {
+                info.textContent += `. Еще не загружены магазины: ${data.unsynced_shops.join(', ')}`;
+            }
+        }
+        SEARCH_RESULTS_DIV.appendChild(info);
+        if (!data.results || data.results.length === 0) return;
+
+        const resultsTable = document.createElement('table');
+        resultsTable.className = 'table table-sm table-bordered mb-0';
+        const headRow = resultsTable.createTHead().insertRow();
+        SEARCH_COLUMNS.concat([[null, '']]).forEach(([, title]) => {
+            const th = document.createElement('th');
+            th.textContent = title;
+            headRow.appendChild(th);
+        });
+        const body = resultsTable.createTBody();
+        data.results.forEach(result => {
+            const tr = body.insertRow();
+            if (result.label_requested) tr.classList.add('label-requested');
+            SEARCH_COLUMNS.forEach(([field]) => {
+                const td = tr.insertCell();
+                const value = result[field];
+                td.textContent = Array.isArray(value) ? value.join(', ') : value;
+                if (result.matched.includes(field) || (field === 'offer_ids' && result.matched.includes('offer_id'))) {
+                    td.classList.add('font-weight-bold');
                 }
-            })
-            .catch(error => {
-                if (LOADER_DIV) LOADER_DIV.style.display = 'none';
-                displayUserMessage(`Сетевая ошибка или ошибка обработки запроса: ${error}`, "error");
             });
+            const actionCell = tr.insertCell();
+            if (result.can_request_label) {
+                const btn = document.createElement('button');
+                btn.className = 'btn btn-info btn-sm';
+                btn.textContent = result.label_requested ? 'Этикетка (повторно)' : 'Этикетка';
+                btn.addEventListener('click', () => requestLabels([result.track_number]));
+                actionCell.appendChild(btn);
+            }
+        });
+        SEARCH_RESULTS_DIV.appendChild(resultsTable);
+    }
+
+    function runSearch() {
+        const query = SEARCH_INPUT.value.trim();
+        if (!query) {
+            SEARCH_RESULTS_DIV.innerHTML = '';
+            return;
+        }
+        const seq = ++searchRequestSeq;
+        fetch(`${searchPostingsUrl}?q=${encodeURIComponent(query)}`)
+            .then(response => response.json())
+            .then(data => {
+                if (seq === searchRequestSeq) renderSearchResults(data); // ответ на устаревший запрос не показываем
+            })
+            .catch(error => displayUserMessage(`Ошибка поиска: ${error}`, "error"));
+    }
+
+    if (SEARCH_INPUT && SEARCH_RESULTS_DIV) {
+        SEARCH_INPUT.addEventListener('input', () => {
+            clearTimeout(searchDebounceTimer);
+            searchDebounceTimer = setTimeout(runSearch, SEARCH_DEBOUNCE_MS);
         });
     }
 
     if (CLEAR_REQUESTED_LABELS_BTN) {
         CLEAR_REQUESTED_LABELS_BTN.addEventListener('click', () => {
-            clearAllRequestedLabels();
-            masterFilter(); 
+            clearAllRequestedLabels().then(masterFilter);
         });
     }
 
     filterInputs.forEach(input => {
-        input.addEventListener('keyup', masterFilter);
+        input.addEventListener('input', scheduleMasterFilter);
     });
 
     if (DOWNLOAD_STATUS_FILTER_SELECT) {